@@ -0,0 +1,257 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import kernels
+from sphere_surface import SURFACE_STORAGES, SphereSurface
+from tectonic_plates import TectonicPlates
+from heigth_map import HeightMap
+
+# Fixed inputs, so timings and map digests are comparable between runs
+DEFAULT_SIZES = (128, 256, 512, 1024, 2048, 4096)
+SMOOTH_WINDOWS = (3, 9, 33)
+SEED = 1234
+NUM_CONTINENTAL = 5
+NUM_OCEANIC = 7
+
+def measure(run, setup=None, repeat=3):
+    """
+    Times run(setup()) repeat times, then once more under tracemalloc.
+    Returns (best seconds, peak bytes allocated by the run on top of what
+    was live before it). setup is not timed.
+    """
+    setup = setup or (lambda: None)
+    best = float("inf")
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        run(arg)
+        best = min(best, time.perf_counter() - start)
+
+    arg = setup()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        run(arg)
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+def new_plates(equator_length, storage="padded"):
+    return TectonicPlates(equator_length, NUM_CONTINENTAL, NUM_OCEANIC, storage=storage, seed=SEED)
+
+def grown_plates(equator_length, storage="padded"):
+    plates = new_plates(equator_length, storage)
+    plates.draw_plates()
+    return plates
+
+def digest(*arrays):
+    sha = hashlib.sha256()
+    for array in arrays:
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+def encode_png(image):
+    image.save(io.BytesIO(), format="PNG")
+
+def benchmark_size(equator_length, storage="padded", repeat=3, tmp_dir=None):
+    """
+    Times every pipeline stage at one resolution; streamed images are
+    written to tmp_dir. Returns (stages, digest) where stages maps stage
+    name -> {"seconds", "peak_bytes", "pixels"} and digest identifies the
+    generated labels and heights.
+    """
+    plates = grown_plates(equator_length, storage)
+    hmap = HeightMap(plates)
+    surface = hmap.height_surface
+    pixels = surface.size()
+    rect_pixels = surface.topology.height * equator_length
+
+    stages = {
+        "plates_init": (lambda _: new_plates(equator_length, storage), None, pixels),
+        "draw_plates": (lambda p: p.draw_plates(), lambda: new_plates(equator_length, storage), pixels),
+        "set_base_heights": (lambda _: hmap.set_base_heights(), None, pixels),
+    }
+    for k in SMOOTH_WINDOWS:
+        stages[f"box_smooth_{k}"] = (lambda _, k=k: hmap._box_smooth(k), None, pixels)
+    stages.update({
+        "to_rectangle_nearest": (lambda _: surface.to_rectangle(), None, rect_pixels),
+        "to_rectangle_linear": (lambda _: surface.to_rectangle("linear"), None, rect_pixels),
+        "plates_image": (lambda _: encode_png(plates.surface_to_image()), None, rect_pixels),
+        "heights_image": (lambda _: encode_png(hmap.to_image()), None, rect_pixels),
+        "heights_save_image": (lambda _: hmap.save_image(os.path.join(tmp_dir, "heights.png")), None, rect_pixels),
+    })
+
+    results = {}
+    for name, (run, setup, stage_pixels) in stages.items():
+        seconds, peak = measure(run, setup, repeat)
+        results[name] = {"seconds": seconds, "peak_bytes": peak, "pixels": stage_pixels}
+    return results, digest(plates.surface.values(), HeightMap(plates).height_surface.values())
+
+def reference_draw_plates(plates):
+    """
+    Per-pixel reference for TectonicPlates.draw_plates: grows every plate
+    frontier one pixel at a time with Python sets.
+    """
+    surface = plates.surface
+    topology = surface.topology
+    borders = {}
+    for plate in plates.plates:
+        borders[plate.plate_id] = set()
+        if surface.get(plate.longitude, plate.latitude) == 0:
+            surface.set(plate.longitude, plate.latitude, plate.plate_id)
+            borders[plate.plate_id].add((plate.longitude, plate.latitude))
+    free = surface.size() - surface.count_nonzero()
+    previous = free
+    while free > 0:
+        for plate in plates.plates:
+            for _ in range(plate.growth_rate):
+                claimed = set()
+                for lon, lat in borders[plate.plate_id]:
+                    for dlon, dlat in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                        nlon = lon + dlon
+                        if 0 <= nlon < topology.height:
+                            nlat = int(topology.wrap(nlon, lat + dlat))
+                            if surface.get(nlon, nlat) == 0:
+                                surface.set(nlon, nlat, plate.plate_id)
+                                claimed.add((nlon, nlat))
+                borders[plate.plate_id] = claimed
+                free -= len(claimed)
+        if free == previous:
+            break
+        previous = free
+
+def reference_box_filter(surface, size):
+    """Per-pixel reference for box_filter, in compact order."""
+    topology = surface.topology
+    return np.array([surface.square_filter(y, x, size) for y, x in zip(topology.rows, topology.cols)])
+
+def reference_to_rectangle(surface):
+    """Per-row reference for to_rectangle: stretch_latitude on every row."""
+    return np.stack([surface.stretch_latitude(surface.row(y), surface.equator_length)
+                     for y in range(surface.topology.height)])
+
+def check_equivalence(sizes):
+    """
+    Compares the vectorized code paths against the per-pixel references
+    (only at small sizes, the references are slow) and the storage engines
+    against each other. Returns a list of (check, equator_length, passed).
+    """
+    checks = []
+    for equator_length in sizes:
+        if equator_length <= 128:
+            plates = new_plates(equator_length)
+            reference_draw_plates(plates)
+            checks.append(("draw_plates", equator_length,
+                           np.array_equal(plates.surface.values(), grown_plates(equator_length).surface.values())))
+
+        if equator_length <= 64:
+            surface = SphereSurface(equator_length, dtype=np.float64)
+            surface.set_values(np.random.default_rng(SEED).random(surface.size()))
+            for k in SMOOTH_WINDOWS:
+                checks.append((f"box_filter_{k}", equator_length,
+                               np.allclose(surface.box_filter(k), reference_box_filter(surface, k))))
+
+        if equator_length <= 512:
+            surface = SphereSurface(equator_length)
+            surface.set_values(np.random.default_rng(SEED).integers(1, 256, surface.size()))
+            checks.append(("to_rectangle", equator_length,
+                           np.array_equal(surface.to_rectangle(), reference_to_rectangle(surface))))
+
+        maps = {}
+        for storage in SURFACE_STORAGES:
+            plates = grown_plates(equator_length, storage)
+            hmap = HeightMap(plates, boundary_terrain=True)
+            maps[storage] = (plates.surface.values(), hmap.height_surface.values(),
+                             np.asarray(plates.surface_to_image()), np.asarray(hmap.to_image()))
+        first, *others = maps.values()
+        for storage, arrays in zip(list(maps)[1:], others):
+            checks.append((f"storage_{storage}", equator_length,
+                           all(np.array_equal(a, b) for a, b in zip(first, arrays))))
+    return checks
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the stages that got slower than baseline by more than tolerance
+    (a fraction) and the sizes whose maps changed. Returns True if the maps
+    are unchanged.
+    """
+    same_maps = True
+    for size, entry in results["sizes"].items():
+        old = baseline["sizes"].get(size)
+        if old is None:
+            continue
+        if entry["digest"] != old["digest"]:
+            print(f"E={size}: generated maps differ from the baseline")
+            same_maps = False
+        for stage, timing in entry["stages"].items():
+            old_timing = old["stages"].get(stage)
+            if old_timing is None:
+                continue
+            ratio = timing["seconds"] / max(old_timing["seconds"], 1e-9)
+            if ratio > 1 + tolerance:
+                print(f"E={size} {stage}: {ratio:.2f}x slower "
+                      f"({old_timing['seconds'] * 1e3:.1f} -> {timing['seconds'] * 1e3:.1f} ms)")
+    return same_maps
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time every map generation stage across resolutions.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="equator lengths")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (the best is kept)")
+    parser.add_argument("--storage", choices=sorted(SURFACE_STORAGES), default="padded")
+    parser.add_argument("--save", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown reported as a regression")
+    parser.add_argument("--check", action="store_true", help="also check output equivalence")
+    parser.add_argument("--backend", choices=("auto",) + kernels.BACKENDS, default=None,
+                        help="kernel backend (default: $MAPGEN_BACKEND or auto)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.backend is not None:
+        kernels.set_backend(args.backend)
+    results = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "storage": args.storage,
+        "backend": kernels.get_backend(),
+        "seed": SEED,
+        "sizes": {},
+    }
+    for equator_length in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stages, map_digest = benchmark_size(equator_length, args.storage, args.repeat, tmp_dir)
+        results["sizes"][str(equator_length)] = {"stages": stages, "digest": map_digest}
+        print(f"E={equator_length}")
+        for stage, timing in stages.items():
+            print(f"  {stage:22s} {timing['seconds'] * 1e3:10.2f} ms "
+                  f"{timing['pixels'] / max(timing['seconds'], 1e-9) / 1e6:9.2f} Mpx/s "
+                  f"{timing['peak_bytes'] / 2**20:9.1f} MiB")
+
+    ok = True
+    if args.check:
+        for check, equator_length, passed in check_equivalence(args.sizes):
+            print(f"check {check:20s} E={equator_length}: {'ok' if passed else 'MISMATCH'}")
+            ok &= bool(passed)
+    if args.compare:
+        with open(args.compare) as f:
+            ok &= compare(results, json.load(f), args.tolerance)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
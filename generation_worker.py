@@ -0,0 +1,192 @@
+import multiprocessing as mp
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from instrumentation import Instrumentation
+from stage_cache import StageCache, cached_plates, cached_heightmap
+
+# Progressive previews are first generated at 1/PREVIEW_SCALE of the equator length,
+# but never below PREVIEW_MIN_LENGTH or with fewer than PREVIEW_PIXELS_PER_PLATE
+# pixels per plate, so every plate of the preview survives refinement
+PREVIEW_SCALE = 8
+PREVIEW_MIN_LENGTH = 32
+PREVIEW_PIXELS_PER_PLATE = 64
+
+def preview_length(eq_len, num_plates):
+    """
+    Returns the equator length of the progressive preview for a map, or
+    None when the map is too small for a coarser preview to be useful.
+    """
+    # a sphere of equator length E has about E**2 / pi pixels
+    min_length = int(np.ceil(np.sqrt(np.pi * PREVIEW_PIXELS_PER_PLATE * num_plates)))
+    coarse_len = max(eq_len // PREVIEW_SCALE, PREVIEW_MIN_LENGTH, min_length)
+    return coarse_len if coarse_len < eq_len else None
+
+class JobCancelled(Exception):
+    """Raised inside the worker when the running job has been superseded."""
+
+class _JobInstrumentation(Instrumentation):
+    """
+    Forwards events of one job to the UI and aborts the job as soon as a
+    newer one has been requested or it was cancelled. Growth reports every
+    step, so even long growth loops stop within one step.
+    """
+    enabled = True
+
+    def __init__(self, job_id, latest, results):
+        self.job_id = job_id
+        self.latest = latest
+        self.results = results
+
+    def event(self, kind, **fields):
+        if self.latest.value != self.job_id:
+            raise JobCancelled()
+        self.results.put(("event", self.job_id, {"event": kind, **fields}))
+
+def generate_images(cache, eq_len, num_cont, num_ocean, base_ocean, base_cont, smooth, seed, terrain,
+                    progressive=False, on_preview=None, instrumentation=None):
+    """
+    Generates (or loads from cache) the plates and heightmap and returns
+    the four preview images as uint8 arrays: plate colours with
+    to_rectangle and to_rectangle2, heights with to_image and to_image2.
+
+    With progressive, the map is first generated at preview_length() and
+    its images are passed to on_preview; the full map is then refined from
+    it (see TectonicPlates.refine), so it is not the map generated for the
+    same seed without progressive. Maps too small for a preview are
+    generated directly.
+    """
+    coarse = None
+    coarse_len = preview_length(eq_len, num_cont + num_ocean)
+    if progressive and coarse_len is not None:
+        coarse, coarse_key = cached_plates(cache, coarse_len, num_cont, num_ocean, seed, instrumentation=instrumentation)
+        on_preview(_images(cache, coarse, coarse_key, base_ocean, base_cont, max(1, smooth // PREVIEW_SCALE), terrain))
+    plates, plates_key = cached_plates(cache, eq_len, num_cont, num_ocean, seed, instrumentation=instrumentation,
+                                       coarse=coarse)
+    return _images(cache, plates, plates_key, base_ocean, base_cont, smooth, terrain)
+
+def _images(cache, plates, plates_key, base_ocean, base_cont, smooth, terrain):
+    img_plate_1 = np.asarray(plates.surface_to_image())
+    try:
+        img_plate_2 = np.asarray(plates.surface_to_image2())
+    except Exception:
+        img_plate_2 = img_plate_1
+
+    hmap = cached_heightmap(cache, plates, plates_key, base_ocean=base_ocean, base_continent=base_cont,
+                            smooth_window=smooth, boundary_terrain=terrain)
+    img_height_1 = np.asarray(hmap.to_image())
+    try:
+        img_height_2 = np.asarray(hmap.to_image2())
+    except Exception:
+        img_height_2 = img_height_1
+    return img_plate_1, img_plate_2, img_height_1, img_height_2
+
+def _to_shared(array):
+    # the receiving side unlinks the block once it has read it
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    block.close()
+    return block.name, array.shape, array.dtype.str
+
+def _from_shared(name, shape, dtype):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+
+def _worker_main(jobs, results, latest, cache_dir):
+    cache = StageCache(cache_dir)
+    while True:
+        job = jobs.get()
+        # latest request wins: skip everything queued behind a newer job
+        while job is not None:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                break
+        if job is None:
+            return
+        job_id, params = job
+        if latest.value != job_id:
+            continue
+        try:
+            def on_preview(images):
+                results.put(("preview", job_id, [_to_shared(image) for image in images]))
+
+            images = generate_images(cache, **params, on_preview=on_preview,
+                                     instrumentation=_JobInstrumentation(job_id, latest, results))
+            results.put(("done", job_id, [_to_shared(image) for image in images]))
+        except JobCancelled:
+            results.put(("cancelled", job_id, None))
+        except Exception as e:
+            results.put(("error", job_id, str(e)))
+
+class GenerationWorker:
+    """
+    Runs map generation in a separate process, so the UI thread keeps the
+    GIL to itself.
+
+    submit() queues a job and makes it the only one that matters: queued
+    older jobs are skipped and a running one is aborted at its next
+    instrumentation event. cancel() aborts without starting anything new.
+    Results come back as shared memory blocks and are read by poll().
+    """
+    def __init__(self, cache_dir):
+        ctx = mp.get_context("spawn")
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._latest = ctx.Value("q", 0)  # id of the only job allowed to run
+        self._next_id = 0
+        self._process = ctx.Process(target=_worker_main, args=(self._jobs, self._results, self._latest, cache_dir),
+                                    daemon=True)
+        self._process.start()
+
+    def submit(self, **params):
+        """
+        Queues a generate_images() call with params and returns its job id.
+        """
+        self._next_id += 1
+        self._latest.value = self._next_id
+        self._jobs.put((self._next_id, params))
+        return self._next_id
+
+    def cancel(self):
+        """
+        Aborts the current job, if any.
+        """
+        self._next_id += 1
+        self._latest.value = self._next_id
+
+    def poll(self):
+        """
+        Returns the messages received since the last call, as (kind, job_id,
+        payload) for the current job only: "event" with an instrumentation
+        record, "preview" (progressive jobs) and "done" with the four image
+        arrays, "error" with a message, or "cancelled". Never blocks.
+        """
+        messages = []
+        while True:
+            try:
+                kind, job_id, payload = self._results.get_nowait()
+            except queue.Empty:
+                return messages
+            if kind in ("preview", "done"):
+                # read even stale results, so their shared memory is freed
+                payload = [_from_shared(*block) for block in payload]
+            if job_id == self._latest.value:
+                messages.append((kind, job_id, payload))
+
+    def close(self):
+        """
+        Stops the worker process and frees unread results.
+        """
+        self.cancel()
+        self._jobs.put(None)
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.terminate()
+        self.poll()
@@ -1,6 +1,7 @@
 import numpy as np
 from PIL import Image
-from sphere_surface import SphereSurface
+from png_writer import write_png
+from tile_export import TilePyramidWriter
 
 class HeightMap:
     """
@@ -11,8 +12,15 @@ class HeightMap:
     - base_ocean: int height value for ocean plates (will be used as integer)
     - base_continent: int height value for continental plates (will be used as integer)
     - smooth_window: odd integer window size for box smoothing (>=1)
+    - dtype: storage type of the heights, e.g. float32 (default) or int16;
+      uint8 reproduces the old 8-bit heightmaps
+    - boundary_terrain: add mountains, trenches, ridges and shelves along
+      plate boundaries (see apply_boundary_terrain) before smoothing
+    - filename: keep the heights in a memory-mapped file; base heights,
+      smoothing and save_image() then work band by band
     """
-    def __init__(self, plates, base_ocean=20, base_continent=60, smooth_window=3):
+    def __init__(self, plates, base_ocean=20, base_continent=60, smooth_window=3, dtype=np.float32, boundary_terrain=False,
+                 filename=None):
         self.plates = plates
         # prefer integer heights
         self.base_ocean = int(base_ocean)
@@ -22,77 +30,222 @@ class HeightMap:
             self.smooth_window += 1
 
         # surface
-        self.height_surface = SphereSurface(self.plates.surface.equator_length)
+        self.height_surface = type(self.plates.surface)(self.plates.surface.equator_length, dtype=dtype, filename=filename)
+
+        # stages are reported to the plates' instrumentation
+        instrumentation = self.plates.instrumentation
+        pixels = self.height_surface.size()
 
         # build raw height map using plate types
-        self.set_base_heights()
+        with instrumentation.stage("base_heights", pixels=pixels):
+            self.set_base_heights()
+        self.boundary_terrain = bool(boundary_terrain)
+        if self.boundary_terrain:
+            with instrumentation.stage("boundary_terrain", pixels=pixels):
+                self.apply_boundary_terrain()
 
-        # apply smoothing (works on float)
+        # apply smoothing in place (accumulates in float64, stored as dtype)
         if self.smooth_window > 1:
-            self.height_surface.surface = self._box_smooth(self.smooth_window)
+            with instrumentation.stage("smoothing", pixels=pixels):
+                self.height_surface.box_filter(self.smooth_window, out=self.height_surface)
 
         # final integer height map (rounded)
         #self.map = np.rint(fmap).astype(np.int16)
 
+    def to_arrays(self):
+        """
+        Returns the heights (compact order) and parameters as a dict of arrays.
+        """
+        return {
+            "heights": self.height_surface.values(),
+            "base_ocean": np.array(self.base_ocean),
+            "base_continent": np.array(self.base_continent),
+            "smooth_window": np.array(self.smooth_window),
+            "boundary_terrain": np.array(self.boundary_terrain),
+        }
+
+    @classmethod
+    def from_arrays(cls, plates, arrays):
+        """
+        Rebuilds a HeightMap for plates from to_arrays() output without
+        recomputing it.
+        """
+        hmap = cls.__new__(cls)
+        hmap.plates = plates
+        hmap.base_ocean = int(arrays["base_ocean"])
+        hmap.base_continent = int(arrays["base_continent"])
+        hmap.smooth_window = int(arrays["smooth_window"])
+        hmap.boundary_terrain = bool(arrays["boundary_terrain"])
+        heights = arrays["heights"]
+        hmap.height_surface = type(plates.surface)(plates.surface.equator_length, dtype=heights.dtype)
+        hmap.height_surface.set_values(heights)
+        return hmap
+
     def set_base_heights(self):
-        surface = self.plates.surface.surface
-
-        plate_types = {p.plate_id: (1 if p.plate_type == 'continental' else 0) for p in self.plates.plates}
-
-        for y in range(np.round(self.height_surface.equator_length/2).astype(int)):
-            length = self.height_surface.pixel_lengths[y]
-            for x in range(self.height_surface.pixel_offsets[y], self.height_surface.pixel_offsets[y]+length):
-                plate_id = surface[y, x]
-                if plate_id == 0:
-                    value = self.base_ocean
-                else:
-                    if plate_types[plate_id] == 1:
-                        value = self.base_continent
-                    else:
-                        value = self.base_ocean
-                self.height_surface.surface[y, x] = value
+        base_heights = self.plates.lookup_table(
+            [self.base_continent if p.plate_type == 'continental' else self.base_ocean for p in self.plates.plates],
+            background=self.base_ocean,
+            dtype=self.height_surface.dtype,
+        )
+        for r0, r1 in self.height_surface.iter_bands():
+            self.height_surface.set_rows_values(r0, r1, base_heights[self.plates.surface.rows_values(r0, r1)])
+
+    def apply_boundary_terrain(self, mountain_height=60, mountain_width=0.02, trench_depth=15, trench_width=0.006,
+                               ridge_height=10, ridge_width=0.01, shelf_width=0.01, inland_height=15, inland_width=0.05):
+        """
+        Shapes the base heights using distance fields seeded from the plate
+        boundaries (breadth-first over the sphere topology, linear in the
+        number of pixels):
+        - mountains on continental plates along convergent boundaries and
+          trenches on the oceanic side, scaled by how fast the plates converge
+        - mid-ocean ridges along divergent oceanic boundaries
+        - continental shelves: ocean rising towards the coast
+        - continents rising with distance from the coast
+        Heights are in the same units as base_ocean/base_continent, widths
+        are fractions of the equator length.
+        """
+        plates = self.plates
+        topology = self.height_surface.topology
+        index = plates.plate_index()
+        labels = plates.surface.values().astype(np.int64)
+        num_ids = len(index.area)
+
+        continental = plates.lookup_table([p.plate_type == 'continental' for p in plates.plates],
+                                          background=False, dtype=bool)
+        convergence = np.zeros((num_ids, num_ids))
+        a, b = index.adjacency[:, 0], index.adjacency[:, 1]
+        pair_convergence = plates.boundary_convergence()
+        convergence[a, b] = pair_convergence
+        convergence[b, a] = pair_convergence
+
+        # classify boundary pixels from the links that cross into another plate;
+        # links can go one way only, so each one counts for both of its ends
+        sources, targets = topology.neighbours_of(index.boundary)
+        own, other = labels[sources], labels[targets]
+        crossing = own != other
+        sources, targets, own, other = sources[crossing], targets[crossing], own[crossing], other[crossing]
+        pixel_convergence = np.zeros(topology.size)
+        np.maximum.at(pixel_convergence, sources, convergence[own, other])
+        np.maximum.at(pixel_convergence, targets, convergence[own, other])
+        coastal = continental[own] != continental[other]
+        coast = np.unique(np.concatenate((sources[coastal], targets[coastal])))
+        divergent = index.boundary[pixel_convergence[index.boundary] <= 0]
+        convergent = index.boundary[pixel_convergence[index.boundary] > 0]
+
+        def pixels(width):
+            return max(1, int(round(width * topology.equator_length)))
+
+        def falloff(distance, width):
+            # 1 on the boundary, 0 from `width` pixels away or when unreached
+            return np.where(distance >= 0, np.clip(1 - distance / width, 0, 1), 0)
+
+        is_continental = continental[labels]
+        delta = np.zeros(topology.size)
+
+        if len(convergent):
+            reach = max(pixels(mountain_width), pixels(trench_width))
+            distance, nearest = topology.distance_from(convergent, max_distance=reach, return_nearest=True)
+            strength = np.where(nearest >= 0, pixel_convergence[nearest], 0) / pixel_convergence.max()
+            delta += np.where(is_continental, mountain_height * strength * falloff(distance, pixels(mountain_width)), 0)
+            delta -= np.where(is_continental, 0, trench_depth * strength * falloff(distance, pixels(trench_width)))
+
+        if len(divergent):
+            distance = topology.distance_from(divergent, max_distance=pixels(ridge_width))
+            delta += np.where(is_continental, 0, ridge_height * falloff(distance, pixels(ridge_width)))
+
+        if len(coast):
+            distance = topology.distance_from(coast)
+            shelf = 0.5 * (self.base_continent - self.base_ocean) * falloff(distance, pixels(shelf_width))
+            delta += np.where(is_continental, inland_height * (1 - falloff(distance, pixels(inland_width))), shelf)
+        else:
+            delta += np.where(is_continental, inland_height, 0)
+
+        heights = self.height_surface.values() + delta
+        if np.issubdtype(self.height_surface.dtype, np.integer):
+            info = np.iinfo(self.height_surface.dtype)
+            heights = np.clip(np.rint(heights), info.min, info.max)
+        self.height_surface.set_values(heights)
 
     def _box_smooth(self, k):
         """Fast box filter via integral image. k must be odd."""
-        equator_length = self.height_surface.equator_length
-        surface = np.zeros((np.round(equator_length/2).astype(int), equator_length), dtype=np.uint8)
-        for y in range(np.round(equator_length/2).astype(int)):
-            length = self.height_surface.pixel_lengths[y]
-            for x in range(self.height_surface.pixel_offsets[y], self.height_surface.pixel_offsets[y]+length):
-                smoothed_value = self.height_surface.square_filter(y, x, k)
-                surface[y, x] = smoothed_value
-        return surface   
+        return self.height_surface.box_filter(k)
+
+    def _normalize(self, rect, mn, mx):
+        """
+        Scales heights from mn..mx to 0..255 uint8, using a single float32
+        temporary whatever the height dtype.
+        """
+        if mx <= mn:
+            return np.zeros(rect.shape, dtype=np.uint8)
+        norm = np.subtract(rect, mn, dtype=np.float32)
+        norm *= 255.0 / (float(mx) - float(mn))
+        np.clip(norm, 0, 255, out=norm)
+        return norm.astype(np.uint8)
 
     def to_image(self, filename=None, mode="L"):
         """
-        Convert integer heightmap to PIL Image.
+        Convert heightmap to PIL Image.
         - mode "L" produces grayscale (0..255). Values will be normalized to 0..255.
         If filename provided, save the image and return the PIL Image.
         """
-        rect = self.height_surface.to_rectangle()
-        mn, mx = self.height_surface.get_min_max()
-        if mx <= mn:
-            norm = np.zeros_like(rect, dtype=np.uint8)
-        else:
-            norm = ((rect - mn) / (mx - mn) * 255.0).astype(np.uint8)
-        img = Image.fromarray(norm, mode)
-        if filename:
-            img.save(filename)
+        instrumentation = self.plates.instrumentation
+        pixels = self.height_surface.topology.height * self.height_surface.equator_length
+        with instrumentation.stage("projection", pixels=pixels):
+            rect = self.height_surface.to_rectangle()
+        with instrumentation.stage("encoding", pixels=pixels):
+            mn, mx = self.height_surface.get_min_max()
+            img = Image.fromarray(self._normalize(rect, mn, mx), mode)
+            if filename:
+                img.save(filename)
         return img
     
     def to_image2(self, filename=None, mode="L"):
         """
-        Convert integer heightmap to PIL Image.
+        Convert heightmap to PIL Image.
         - mode "L" produces grayscale (0..255). Values will be normalized to 0..255.
         If filename provided, save the image and return the PIL Image.
         """
         rect = self.height_surface.to_rectangle2()
         mn, mx = self.height_surface.get_min_max()
-        if mx <= mn:
-            norm = np.zeros_like(rect, dtype=np.uint8)
-        else:
-            norm = ((rect - mn) / (mx - mn) * 255.0).astype(np.uint8)
-        img = Image.fromarray(norm, mode)
+        img = Image.fromarray(self._normalize(rect, mn, mx), mode)
         if filename:
             img.save(filename)
-        return img
\ No newline at end of file
+        return img
+
+    def save_image(self, filename, band_rows=None, bits=8):
+        """
+        Writes the normalized heightmap to a grayscale PNG file band by band,
+        without holding the full rectangle in memory. bits=16 keeps 65536
+        height levels instead of 256. With bits=8 the image is the same as
+        to_image() up to NEAREST_STREAM_MAX_LENGTH (see
+        SphereSurface.iter_rectangle).
+        """
+        mn, mx = self.height_surface.get_min_max()
+        if bits == 16:
+            scale = 65535.0 / (float(mx) - float(mn)) if mx > mn else 0.0
+            bands = (np.clip(np.rint((rect - float(mn)) * scale), 0, 65535)
+                     for _, rect in self.height_surface.iter_rectangle(band_rows))
+            mode = "I;16"
+        else:
+            bands = (self._normalize(rect, mn, mx) for _, rect in self.height_surface.iter_rectangle(band_rows))
+            mode = "L"
+        width, height = self.height_surface.equator_length, self.height_surface.topology.height
+        with self.plates.instrumentation.stage("export", pixels=width * height):
+            write_png(filename, width, height, bands, mode)
+
+    def export_tiles(self, out_dir, tile_size=256, band_rows=None, workers=None):
+        """
+        Writes the heights as a pyramid of 16-bit grayscale PNG tiles (see
+        TilePyramidWriter), streaming the projection band by band. Tile
+        values v map back to heights as min + v * (max - min) / 65535, with
+        min and max recorded in tiles.json.
+        """
+        mn, mx = self.height_surface.get_min_max()
+        scale = 65535.0 / (float(mx) - float(mn)) if mx > mn else 0.0
+        metadata = {"min_height": float(mn), "max_height": float(mx)}
+        width, height = self.height_surface.equator_length, self.height_surface.topology.height
+        with self.plates.instrumentation.stage("export", pixels=width * height):
+            with TilePyramidWriter(out_dir, width, height, "I;16",
+                                   tile_size=tile_size, workers=workers, metadata=metadata) as writer:
+                for _, rect in self.height_surface.iter_rectangle(band_rows):
+                    writer.write((rect - float(mn)) * scale)
@@ -0,0 +1,76 @@
+import contextlib
+import time
+import tracemalloc
+
+class Instrumentation:
+    """
+    Receives structured events from the generation pipeline.
+
+    The base class ignores everything: enabled is False, so the pipeline
+    skips building per-step events, and stage() only costs a context
+    manager per stage. Subclasses set enabled = True and override event(),
+    which is called with the event kind and its fields:
+    - "stage": stage, seconds, pixels, pixels_per_second and, when
+      tracemalloc is tracing, peak_bytes (peak traced memory, numpy
+      arrays included, during the stage)
+    - "growth_step": step, free_pixels, total_pixels, frontier_pixels
+      (pixels on all plate frontiers after the step) and claimed_pixels
+    Stages are "seeding", "growth", "refinement" (upsampling a coarse map,
+    see TectonicPlates.refine), "base_heights", "boundary_terrain",
+    "smoothing", "projection", "encoding" and "export" (streamed
+    projection and encoding of save_image/export_tiles).
+    """
+    enabled = False
+
+    def event(self, kind, **fields):
+        pass
+
+    @contextlib.contextmanager
+    def stage(self, name, pixels=0):
+        """
+        Times the enclosed block and reports it as a "stage" event.
+        """
+        if not self.enabled:
+            yield
+            return
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        fields = {
+            "stage": name,
+            "seconds": seconds,
+            "pixels": int(pixels),
+            "pixels_per_second": pixels / seconds if seconds > 0 else 0.0,
+        }
+        if tracing:
+            fields["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        self.event("stage", **fields)
+
+# shared default for everything that is not instrumented
+NO_INSTRUMENTATION = Instrumentation()
+
+class EventRecorder(Instrumentation):
+    """
+    Keeps every event as a dict ({"event": kind, "time": seconds since the
+    recorder was created, **fields}) in self.events, and passes it to
+    callback if one is given. The callback runs on the generating thread.
+    With trace_memory, tracemalloc is started so stages report peak_bytes
+    (this slows allocation-heavy code down noticeably).
+    """
+    enabled = True
+
+    def __init__(self, callback=None, trace_memory=False):
+        self.callback = callback
+        self.events = []
+        self.start = time.perf_counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def event(self, kind, **fields):
+        record = {"event": kind, "time": time.perf_counter() - self.start, **fields}
+        self.events.append(record)
+        if self.callback is not None:
+            self.callback(record)
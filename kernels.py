@@ -0,0 +1,154 @@
+import os
+import warnings
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # optional: the NumPy code paths are used without it
+    numba = None
+
+# "numpy" is always available; "numba" needs the numba package
+BACKENDS = ("numpy", "numba")
+
+_backend = None
+
+def available_backends():
+    """
+    Returns the backends that can be used in this environment.
+    """
+    return BACKENDS if numba is not None else ("numpy",)
+
+def set_backend(name="auto"):
+    """
+    Selects the kernels used for plate growth, box smoothing and projection.
+    "auto" picks numba when it is installed; asking for numba without it
+    warns and falls back to numpy. Every backend gives identical output.
+    """
+    global _backend
+    if name == "auto":
+        name = "numba" if numba is not None else "numpy"
+    if name not in BACKENDS:
+        raise ValueError(f"unknown backend {name!r}, expected one of {BACKENDS} or 'auto'")
+    if name == "numba" and numba is None:
+        warnings.warn("numba is not installed, using the numpy backend")
+        name = "numpy"
+    _backend = name
+
+def get_backend():
+    """
+    Returns the selected backend name, initialised from $MAPGEN_BACKEND
+    (default "auto") on first use.
+    """
+    if _backend is None:
+        set_backend(os.environ.get("MAPGEN_BACKEND", "auto"))
+    return _backend
+
+def use_numba():
+    return get_backend() == "numba"
+
+if numba is not None:
+    # compiled on first use and cached next to this file
+    jit = numba.njit(nogil=True, cache=True)
+    parallel_jit = numba.njit(nogil=True, parallel=True, cache=True)
+
+    @jit
+    def grow(neighbour_ptr, neighbours, labels, frontier, plate_id):
+        """
+        Claims the free (label 0) neighbours of frontier for plate_id.
+        Returns the claimed pixels, in the order they were claimed; the set
+        is the same as np.unique in the NumPy path. Plates grow one after
+        another, so this loop is serial, but it releases the GIL.
+        """
+        capacity = 0
+        for pixel in frontier:
+            capacity += neighbour_ptr[pixel + 1] - neighbour_ptr[pixel]
+        claimed = np.empty(capacity, dtype=np.int64)
+        count = 0
+        for pixel in frontier:
+            for k in range(neighbour_ptr[pixel], neighbour_ptr[pixel + 1]):
+                neighbour = neighbours[k]
+                if labels[neighbour] == 0:
+                    labels[neighbour] = plate_id
+                    claimed[count] = neighbour
+                    count += 1
+        return claimed[:count]
+
+    @parallel_jit
+    def box_filter_band(values, y0, y1, size, pixel_lengths, pixel_offsets, row_starts, equator_length, height,
+                        integer, out):
+        """
+        SphereTopology.box_filter_band for 1-D values, written into out.
+        The prefix sums are accumulated serially in the same order as
+        np.cumsum so results are bit-identical; the per-row window sums,
+        the per-column vertical sums and the output rows run in parallel.
+        """
+        half_size = size // 2
+        r0 = max(0, y0 - half_size)
+        r1 = min(height, y1 + half_size)
+        num_rows = r1 - r0
+        base_start = row_starts[r0]
+
+        prefix = np.empty(2 * len(values) + 1)
+        prefix[0] = 0.0
+        position = 0
+        for k in range(num_rows):
+            start = row_starts[r0 + k] - base_start
+            length = pixel_lengths[r0 + k]
+            for turn in range(2):
+                for j in range(length):
+                    prefix[position + 1] = prefix[position] + values[start + j]
+                    position += 1
+
+        sums = np.empty((num_rows, equator_length))
+        for k in numba.prange(num_rows):
+            length = pixel_lengths[r0 + k]
+            offset = pixel_offsets[r0 + k]
+            base = 2 * (row_starts[r0 + k] - base_start)
+            full_turns = size // length
+            rest = size % length
+            row_total = prefix[base + length] - prefix[base]
+            for x in range(equator_length):
+                start = (x - half_size - offset) % length
+                sums[k, x] = full_turns * row_total + prefix[base + start + rest] - prefix[base + start]
+
+        column_sums = np.empty((num_rows + 1, equator_length))
+        for x in numba.prange(equator_length):
+            column_sums[0, x] = 0.0
+            for k in range(num_rows):
+                column_sums[k + 1, x] = column_sums[k, x] + sums[k, x]
+
+        for y in numba.prange(y0, y1):
+            lo = max(y - half_size, 0)
+            hi = min(y + half_size + 1, height)
+            count = (hi - lo) * size
+            offset = pixel_offsets[y]
+            first = row_starts[y] - row_starts[y0]
+            for j in range(pixel_lengths[y]):
+                total = column_sums[hi - r0, offset + j] - column_sums[lo - r0, offset + j]
+                if integer:
+                    out[first + j] = total // count
+                else:
+                    out[first + j] = total / count
+
+    @parallel_jit
+    def gather_rows(source, index, out):
+        """out[y, x] = source[index[y, x]], rows in parallel."""
+        for y in numba.prange(index.shape[0]):
+            for x in range(index.shape[1]):
+                out[y, x] = source[index[y, x]]
+
+    @parallel_jit
+    def interpolate_rows(source, left, right, weight, integer, out):
+        """
+        out = source[left] * (1 - weight) + source[right] * weight, rounded
+        to the nearest integer when integer is set, rows in parallel. weight
+        is float32 (see SphereTopology.projection_rows) and the arithmetic
+        is done in the same types as the NumPy expression.
+        """
+        one = np.float32(1)
+        for y in numba.prange(left.shape[0]):
+            for x in range(left.shape[1]):
+                w = weight[y, x]
+                value = source[left[y, x]] * (one - w) + source[right[y, x]] * w
+                out[y, x] = np.rint(value) if integer else value
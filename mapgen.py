@@ -1,16 +1,40 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
-from PIL import ImageTk
-import threading
-
-from tectonic_plates import TectonicPlates
-from heigth_map import HeightMap
+from PIL import Image, ImageTk
+import os
+import random
+
+from generation_worker import GenerationWorker
+
+# Plate maps and heightmaps are cached here so parameter tweaks are cheap
+CACHE_DIR = os.environ.get("MAPGEN_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "map_gen"))
+
+# How often the UI checks the generation worker for progress and results (ms)
+POLL_INTERVAL = 50
+
+# Progress bar position (0..100) once a stage is done; growth fills up to its entry step by step
+STAGE_PROGRESS = {
+    "seeding": 2,
+    "refinement": 10,
+    "growth": 70,
+    "base_heights": 74,
+    "boundary_terrain": 80,
+    "smoothing": 85,
+    "projection": 90,
+    "encoding": 95,
+}
 
 class MapGenUI(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("Tectonic Plates MapGen")
         self._build_controls()
+        # generation runs in a worker process; only the latest request is kept
+        self.worker = GenerationWorker(CACHE_DIR)
+        self.job_id = None
+        self.progress_value = 0.0
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.after(POLL_INTERVAL, self._poll_worker)
         # keep PhotoImage refs to avoid GC
         self.tk_img_a = None
         self.tk_img_b = None
@@ -55,9 +79,33 @@ class MapGenUI(tk.Tk):
         self.smooth_spin = ttk.Spinbox(frm, from_=1, to=99, textvariable=self.smooth_var, width=8)
         self.smooth_spin.grid(row=5, column=1, sticky="w", padx=6)
 
+        # Seed (a new one is drawn on every Generate while "Random" is checked)
+        ttk.Label(frm, text="Seed:").grid(row=6, column=0, sticky="w")
+        self.seed_var = tk.IntVar(value=0)
+        self.seed_spin = ttk.Spinbox(frm, from_=0, to=2**31 - 1, textvariable=self.seed_var, width=12)
+        self.seed_spin.grid(row=6, column=1, sticky="w", padx=6)
+        self.random_seed_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(frm, text="Random", variable=self.random_seed_var).grid(row=6, column=2, sticky="w")
+
+        # Mountains, trenches and shelves along plate boundaries
+        self.terrain_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frm, text="Boundary terrain", variable=self.terrain_var).grid(row=7, column=0, columnspan=2, sticky="w")
+
+        # Show a 1/8 scale map first, then refine it to full resolution
+        self.progressive_var = tk.BooleanVar(value=True)
+        # a progressive map is refined from its preview, so it differs from the
+        # map mapgen_batch.py generates for the same seed
+        ttk.Checkbutton(frm, text="Progressive preview (differs from batch map)", variable=self.progressive_var).grid(row=8, column=0, columnspan=2, sticky="w")
+
+        # Generation progress, driven by instrumentation events
+        self.progress_var = tk.DoubleVar(value=0)
+        ttk.Progressbar(frm, variable=self.progress_var, maximum=100).grid(row=9, column=0, columnspan=3, sticky="ew", pady=(6, 0))
+
         # Generate button
         self.gen_btn = ttk.Button(frm, text="Generate", command=self.on_generate)
         self.gen_btn.grid(row=0, column=2, rowspan=6, padx=12)
+        self.cancel_btn = ttk.Button(frm, text="Cancel", command=self.on_cancel, state="disabled")
+        self.cancel_btn.grid(row=7, column=2, padx=12)
 
         # Canvas/frame for 2x2 images
         self.images_frame = ttk.Frame(self, padding=8)
@@ -88,45 +136,67 @@ class MapGenUI(tk.Tk):
             base_ocean = int(self.base_ocean_var.get())
             base_cont = int(self.base_cont_var.get())
             smooth = int(self.smooth_var.get())
-            if eq < 4 or cont < 1 or ocean < 0:
+            if self.random_seed_var.get():
+                self.seed_var.set(random.randrange(2**31))
+            seed = int(self.seed_var.get())
+            terrain = bool(self.terrain_var.get())
+            progressive = bool(self.progressive_var.get())
+            if eq < 4 or cont < 1 or ocean < 0 or seed < 0:
                 raise ValueError
         except Exception:
             messagebox.showerror("Invalid input", "Please enter valid numeric values.")
             return
 
-        self.gen_btn.config(state="disabled")
-        threading.Thread(
-            target=self._generate_thread,
-            args=(eq, cont, ocean, base_ocean, base_cont, smooth),
-            daemon=True
-        ).start()
-
-    def _generate_thread(self, eq_len, num_cont, num_ocean, base_ocean, base_cont, smooth):
-        try:
-            plates = TectonicPlates(equator_length=eq_len, num_continental=num_cont, num_oceanic=num_ocean)
-            plates.draw_plates()  # may log progress to console
-
-            # plate image variants
-            img_plate_1 = plates.surface_to_image()
-            try:
-                img_plate_2 = plates.surface_to_image2()
-            except Exception:
-                img_plate_2 = img_plate_1.copy()
-
-            # heightmap variants
-            hmap = HeightMap(plates, base_ocean=base_ocean, base_continent=base_cont, smooth_window=smooth)
-            img_height_1 = hmap.to_image()
-            try:
-                img_height_2 = hmap.to_image2()
-            except Exception:
-                img_height_2 = img_height_1.copy()
-
-            self.after(0, self._update_images, img_plate_1, img_plate_2, img_height_1, img_height_2)
-        except Exception as e:
-            self.after(0, lambda: messagebox.showerror("Generation error", str(e)))
-            self.after(0, lambda: self.gen_btn.config(state="normal"))
+        # a newer request preempts whatever is still running
+        self.job_id = self.worker.submit(
+            eq_len=eq, num_cont=cont, num_ocean=ocean, base_ocean=base_ocean, base_cont=base_cont,
+            smooth=smooth, seed=seed, terrain=terrain, progressive=progressive,
+        )
+        self.progress_value = 0.0
+        self.progress_var.set(0)
+        self.cancel_btn.config(state="normal")
+
+    def on_cancel(self):
+        self.worker.cancel()
+        self.job_id = None
+        self.progress_var.set(0)
+        self.cancel_btn.config(state="disabled")
+
+    def on_close(self):
+        self.worker.close()
+        self.destroy()
+
+    def _poll_worker(self):
+        for kind, job_id, payload in self.worker.poll():
+            if job_id != self.job_id:
+                continue
+            if kind == "event":
+                self._on_progress(payload)
+            elif kind == "preview":
+                # the bar restarts for the full resolution pass
+                self._update_images(*(Image.fromarray(image) for image in payload))
+                self.progress_value = 0.0
+                self.progress_var.set(0)
+            elif kind == "done":
+                self._update_images(*(Image.fromarray(image) for image in payload))
+                self.progress_var.set(100)
+            elif kind == "error":
+                messagebox.showerror("Generation error", payload)
+            if kind not in ("event", "preview"):
+                self.job_id = None
+                self.cancel_btn.config(state="disabled")
+        self.after(POLL_INTERVAL, self._poll_worker)
+
+    def _on_progress(self, record):
+        if record["event"] == "growth_step":
+            done = 1 - record["free_pixels"] / max(record["total_pixels"], 1)
+            value = STAGE_PROGRESS["seeding"] + done * (STAGE_PROGRESS["growth"] - STAGE_PROGRESS["seeding"])
         else:
-            self.after(0, lambda: self.gen_btn.config(state="normal"))
+            value = STAGE_PROGRESS.get(record.get("stage"), self.progress_value)
+        # growth can take thousands of steps: only redraw on whole percents
+        if int(value) > int(self.progress_value):
+            self.progress_value = value
+            self.progress_var.set(value)
 
     def _update_images(self, pil_a, pil_b, pil_c, pil_d):
         # keep references to PhotoImage to avoid garbage collection
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tectonic_plates import TectonicPlates
+from heigth_map import HeightMap
+from instrumentation import EventRecorder
+from world_batch import WorldBatch
+from world_file import save_world
+
+def generate_map(seed, eq_len, num_cont, num_ocean, base_ocean, base_cont, smooth, out_dir, record_events=False):
+    """
+    Generates one map from its seed and writes it to out_dir:
+    plates_<seed>.png, heights_<seed>.png and world_<seed>.world with the
+    labels, heights and plate table (see world_file.py). Returns (seed, valid pixel count,
+    instrumentation events or None).
+    """
+    recorder = EventRecorder() if record_events else None
+    plates = TectonicPlates(equator_length=eq_len, num_continental=num_cont, num_oceanic=num_ocean, seed=seed,
+                            instrumentation=recorder)
+    plates.draw_plates()
+    hmap = HeightMap(plates, base_ocean=base_ocean, base_continent=base_cont, smooth_window=smooth)
+    save_map(seed, plates, hmap, out_dir)
+    return seed, plates.surface.size(), recorder and recorder.events
+
+def generate_batch(seeds, eq_len, num_cont, num_ocean, base_ocean, base_cont, smooth, out_dir, record_events=False):
+    """
+    Same as generate_map for several seeds at once, using WorldBatch.
+    Returns (seeds, valid pixel count of all maps, events or None).
+    """
+    recorder = EventRecorder() if record_events else None
+    batch = WorldBatch(eq_len, seeds, num_cont, num_ocean, instrumentation=recorder)
+    batch.draw_plates()
+    batch.set_heights(base_ocean=base_ocean, base_continent=base_cont, smooth_window=smooth)
+    for b, seed in enumerate(seeds):
+        save_map(seed, *batch.world(b), out_dir)
+    return list(seeds), batch.labels.size, recorder and recorder.events
+
+def save_map(seed, plates, hmap, out_dir):
+    """
+    Writes the images and the world file of one map to out_dir.
+    """
+    plates.surface_to_image().save(os.path.join(out_dir, f"plates_{seed}.png"))
+    hmap.to_image(os.path.join(out_dir, f"heights_{seed}.png"))
+    save_world(os.path.join(out_dir, f"world_{seed}.world"), plates, hmap, compression="zlib")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate tectonic plate maps without the UI.")
+    parser.add_argument("--seed-start", type=int, default=0, help="first seed (inclusive)")
+    parser.add_argument("--seed-end", type=int, default=10, help="last seed (exclusive)")
+    parser.add_argument("--equator-length", type=int, default=128)
+    parser.add_argument("--continental", type=int, default=5)
+    parser.add_argument("--oceanic", type=int, default=7)
+    parser.add_argument("--base-ocean", type=int, default=20)
+    parser.add_argument("--base-continent", type=int, default=60)
+    parser.add_argument("--smooth", type=int, default=3, help="smooth window")
+    parser.add_argument("--out", default="maps", help="output directory")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=1, help="worlds generated together by each task")
+    parser.add_argument("--events", default=None, help="write per-task stage timings and growth steps to this JSON file")
+    args = parser.parse_args(argv)
+    if args.equator_length < 4 or args.continental < 1 or args.oceanic < 0:
+        parser.error("equator length must be >= 4, continental >= 1 and oceanic >= 0")
+    if args.seed_end <= args.seed_start:
+        parser.error("--seed-end must be greater than --seed-start")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.out, exist_ok=True)
+    seeds = range(args.seed_start, args.seed_end)
+
+    start = time.perf_counter()
+    total_pixels = 0
+    events = []
+    params = (args.equator_length, args.continental, args.oceanic, args.base_ocean, args.base_continent, args.smooth,
+              args.out, args.events is not None)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        if args.batch_size == 1:
+            futures = [pool.submit(generate_map, seed, *params) for seed in seeds]
+        else:
+            futures = [pool.submit(generate_batch, seeds[i:i + args.batch_size], *params)
+                       for i in range(0, len(seeds), args.batch_size)]
+        for future in as_completed(futures):
+            task_seeds, pixels, task_events = future.result()
+            task_seeds = task_seeds if isinstance(task_seeds, list) else [task_seeds]
+            total_pixels += pixels
+            if task_events is not None:
+                events.append({"seeds": task_seeds, "events": task_events})
+            print(f"Seed{'s' if len(task_seeds) > 1 else ''} {', '.join(map(str, task_seeds))} done")
+    elapsed = time.perf_counter() - start
+
+    if args.events is not None:
+        with open(args.events, "w") as f:
+            json.dump({"elapsed": elapsed, "tasks": sorted(events, key=lambda task: task["seeds"][0])}, f, indent=1)
+
+    print(f"Generated {len(seeds)} maps in {elapsed:.2f}s: "
+          f"{len(seeds) / elapsed:.2f} maps/s, {total_pixels / elapsed / 1e6:.2f} Mpixels/s")
+
+if __name__ == "__main__":
+    main()
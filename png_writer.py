@@ -0,0 +1,44 @@
+import struct
+import zlib
+
+import numpy as np
+
+# PNG colour type and bit depth per image mode (same names as PIL)
+PNG_MODES = {
+    "L": (0, 8, np.dtype(np.uint8), 1),
+    "I;16": (0, 16, np.dtype(">u2"), 1),
+    "RGB": (2, 8, np.dtype(np.uint8), 3),
+}
+
+def _chunk(f, kind, data):
+    f.write(struct.pack(">I", len(data)))
+    f.write(kind)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+def write_png(filename, width, height, bands, mode="L", level=6):
+    """
+    Writes a PNG image from an iterable of row bands, so the whole image
+    never has to be in memory. Each band is an (n, width) array, or
+    (n, width, 3) for "RGB"; "I;16" stores 16-bit grayscale. The bands
+    must add up to height rows.
+    """
+    color_type, bit_depth, dtype, channels = PNG_MODES[mode]
+    compressor = zlib.compressobj(level)
+    rows_written = 0
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        _chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, bit_depth, color_type, 0, 0, 0))
+        for band in bands:
+            band = np.ascontiguousarray(band, dtype=dtype).reshape(len(band), width * channels)
+            # filter type 0 (none) in front of every scanline
+            scanlines = np.zeros((len(band), 1 + band.itemsize * width * channels), dtype=np.uint8)
+            scanlines[:, 1:] = band.view(np.uint8)
+            rows_written += len(band)
+            data = compressor.compress(scanlines.tobytes())
+            if data:
+                _chunk(f, b"IDAT", data)
+        if rows_written != height:
+            raise ValueError(f"got {rows_written} rows for a {height} row image")
+        _chunk(f, b"IDAT", compressor.flush())
+        _chunk(f, b"IEND", b"")
@@ -1,12 +1,483 @@
+import functools
 import numpy as np
 
-class SphereSurface:
+import kernels
+
+# Up to this equator length streamed projections (iter_rectangle) use the
+# "nearest" method and match to_rectangle() exactly; above it its O(E)
+# Python loop per band is too slow and "uniform" is used instead
+NEAREST_STREAM_MAX_LENGTH = 4096
+
+class SphereTopology:
+    """
+    Pixel layout and neighbour lookups shared by every surface of one equator_length.
+
+    Valid pixels are numbered row by row in a flat "compact" index. For each
+    of them the table keeps its row, its column in the padded surface array
+    and, on demand, a CSR-style neighbour list (neighbour_ptr, neighbours).
+    Per-pixel tables are only built when first used, so band-by-band work
+    on very large spheres needs just the per-row geometry.
+    Use sphere_topology() to get the cached instance for a resolution.
+    """
     def __init__(self, equator_length):
         self.equator_length = equator_length
-        # Memory-efficient array: using uint8 for pixel data
-        self.surface = np.zeros((np.round(equator_length/2).astype(int), equator_length), dtype=np.uint8)
-        self.pixel_lengths = self.latitude_pixel_lengths()
-        self.pixel_offsets = self.latitude_pixel_offsets()
+        self.height = int(np.round(equator_length/2))
+
+        latitudes = np.linspace(-np.pi/2, np.pi/2, self.height)
+        self.pixel_lengths = np.round(equator_length * np.cos(latitudes)).astype(int)
+        self.pixel_lengths[self.pixel_lengths < 1] = 1  # Ensure minimum length is 1
+        self.pixel_offsets = (equator_length - self.pixel_lengths) // 2
+
+        self.row_starts = np.zeros(self.height + 1, dtype=np.int64)
+        np.cumsum(self.pixel_lengths, out=self.row_starts[1:])
+        self.size = int(self.row_starts[-1])
+        self._tables = {}  # lazily built tables, keyed by kind
+
+        for arr in (self.pixel_lengths, self.pixel_offsets, self.row_starts):
+            arr.flags.writeable = False
+
+    @functools.cached_property
+    def rows(self):
+        """Row of every compact pixel."""
+        rows = np.repeat(np.arange(self.height, dtype=np.int32), self.pixel_lengths)
+        rows.flags.writeable = False
+        return rows
+
+    @functools.cached_property
+    def cols(self):
+        """Column in the padded surface array of every compact pixel."""
+        cols = (np.arange(self.size) - self.row_starts[self.rows] + self.pixel_offsets[self.rows]).astype(np.int32)
+        cols.flags.writeable = False
+        return cols
+
+    @functools.cached_property
+    def flat_index(self):
+        """Index into the flattened padded surface array of every compact pixel."""
+        flat_index = self.rows.astype(np.int64) * self.equator_length + self.cols
+        flat_index.flags.writeable = False
+        return flat_index
+
+    def band_mask(self, r0, r1):
+        """
+        Returns an (r1 - r0, equator_length) boolean mask of the valid cells
+        of rows r0..r1; selecting with it yields the rows in compact order.
+        """
+        cols = np.arange(self.equator_length)
+        offsets = self.pixel_offsets[r0:r1, None]
+        return (cols >= offsets) & (cols < offsets + self.pixel_lengths[r0:r1, None])
+
+    def wrap(self, rows, cols):
+        """
+        Wraps column indices into the valid band of the given rows.
+        """
+        offsets = self.pixel_offsets[rows]
+        return offsets + (cols - offsets) % self.pixel_lengths[rows]
+
+    def compact(self, rows, cols):
+        """
+        Returns the compact index of (row, column) after wrapping the column.
+        """
+        return self.row_starts[rows] + (self.wrap(rows, cols) - self.pixel_offsets[rows])
+
+    def neighbours(self, connectivity=4):
+        """
+        Returns (neighbour_ptr, neighbours): the neighbours of compact pixel i
+        are neighbours[neighbour_ptr[i]:neighbour_ptr[i+1]].
+        connectivity 4 gives S, N, W, E; 8 adds the diagonals.
+        Rows do not wrap over the poles.
+        """
+        if connectivity not in (4, 8):
+            raise ValueError("connectivity must be 4 or 8")
+        key = ("neighbours", connectivity)
+        if key not in self._tables:
+            self._tables[key] = self._build_neighbours(connectivity)
+        return self._tables[key]
+
+    def _build_neighbours(self, connectivity):
+        directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+        if connectivity == 8:
+            directions += [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+        pixels = np.arange(self.size, dtype=np.int32)
+        table = np.full((self.size, len(directions)), -1, dtype=np.int32)
+        for d, (drow, dcol) in enumerate(directions):
+            nrow = self.rows + drow
+            inside = (nrow >= 0) & (nrow < self.height)
+            nbr = self.compact(nrow[inside], self.cols[inside] + dcol)
+            # narrow polar rows can wrap a pixel onto itself
+            nbr[nbr == pixels[inside]] = -1
+            table[inside, d] = nbr
+
+        present = table >= 0
+        neighbour_ptr = np.zeros(self.size + 1, dtype=np.int64)
+        np.cumsum(present.sum(axis=1), out=neighbour_ptr[1:])
+        neighbours = table[present]
+        neighbour_ptr.flags.writeable = False
+        neighbours.flags.writeable = False
+        return neighbour_ptr, neighbours
+
+    def neighbours_of(self, pixels, connectivity=4):
+        """
+        Gathers the neighbours of an array of compact pixels.
+        Returns (sources, neighbours) where sources[i] is the pixel whose
+        neighbour is neighbours[i].
+        """
+        neighbour_ptr, neighbours = self.neighbours(connectivity)
+        starts = neighbour_ptr[pixels]
+        counts = neighbour_ptr[pixels + 1] - starts
+        ends = np.cumsum(counts)
+        positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - counts), counts)
+        return np.repeat(pixels, counts), neighbours[positions]
+
+    def distance_from(self, sources, connectivity=4, max_distance=None, return_nearest=False):
+        """
+        Multi-source breadth-first distance, in pixel steps, from the given
+        compact pixels to every other pixel. Each level expands the whole
+        frontier at once, so the cost is linear in the pixels reached.
+        Pixels further than max_distance (or unreachable) get -1.
+        With return_nearest, also returns the source each pixel was reached
+        from (-1 where unreached).
+        """
+        distance = np.full(self.size, -1, dtype=np.int32)
+        frontier = np.unique(np.asarray(sources, dtype=np.int64))
+        distance[frontier] = 0
+        nearest = None
+        if return_nearest:
+            nearest = np.full(self.size, -1, dtype=np.int64)
+            nearest[frontier] = frontier
+
+        level = 0
+        while len(frontier) and (max_distance is None or level < max_distance):
+            level += 1
+            parents, candidates = self.neighbours_of(frontier, connectivity)
+            fresh = distance[candidates] < 0
+            frontier, first = np.unique(candidates[fresh], return_index=True)
+            distance[frontier] = level
+            if return_nearest:
+                nearest[frontier] = nearest[parents[fresh][first]]
+        if return_nearest:
+            return distance, nearest
+        return distance
+
+    def coordinates(self):
+        """
+        Returns (latitudes, longitudes) in radians of every compact pixel.
+        Latitudes run from -pi/2 (row 0) to pi/2, longitudes from -pi to pi
+        across each row, taken at the pixel centre.
+        """
+        key = ("coordinates",)
+        if key not in self._tables:
+            latitudes, longitudes = self.band_coordinates(0, self.height)
+            latitudes.flags.writeable = False
+            longitudes.flags.writeable = False
+            self._tables[key] = latitudes, longitudes
+        return self._tables[key]
+
+    def band_coordinates(self, r0, r1):
+        """
+        Returns coordinates() for the compact pixels of rows r0..r1 only,
+        without building the whole-sphere tables.
+        """
+        row_latitudes = np.linspace(-np.pi/2, np.pi/2, self.height)
+        rows = np.repeat(np.arange(r0, r1), self.pixel_lengths[r0:r1])
+        position = np.arange(self.row_starts[r0], self.row_starts[r1]) - self.row_starts[rows]
+        latitudes = row_latitudes[rows]
+        longitudes = (position + 0.5) / self.pixel_lengths[rows] * 2 * np.pi - np.pi
+        return latitudes, longitudes
+
+    def _latitude_rows(self, min_latitude, max_latitude):
+        # rows r0..r1 are those whose latitude lies in [min_latitude, max_latitude]
+        row_latitudes = np.linspace(-np.pi/2, np.pi/2, self.height)
+        r0 = int(np.searchsorted(row_latitudes, min_latitude, side="left"))
+        r1 = int(np.searchsorted(row_latitudes, max_latitude, side="right"))
+        return r0, max(r0, r1)
+
+    def pixels_in_rectangle(self, min_latitude, max_latitude, min_longitude, max_longitude):
+        """
+        Returns the compact indices (ascending) of the pixels whose centre
+        lies in a latitude/longitude rectangle, in radians as returned by
+        coordinates(). A min_longitude above max_longitude selects the
+        rectangle across the +-pi meridian.
+        """
+        r0, r1 = self._latitude_rows(min_latitude, max_latitude)
+        _, longitudes = self.band_coordinates(r0, r1)
+        if min_longitude <= max_longitude:
+            inside = (longitudes >= min_longitude) & (longitudes <= max_longitude)
+        else:
+            inside = (longitudes >= min_longitude) | (longitudes <= max_longitude)
+        return self.row_starts[r0] + np.flatnonzero(inside)
+
+    def pixels_within(self, latitude, longitude, radius):
+        """
+        Returns the compact indices (ascending) of the pixels whose centre
+        is at most radius (the great-circle angle, in radians) from the
+        point (latitude, longitude). Only the rows that can be that close
+        are looked at.
+        """
+        r0, r1 = self._latitude_rows(latitude - radius, latitude + radius)
+        latitudes, longitudes = self.band_coordinates(r0, r1)
+        cos_distance = (np.sin(latitude) * np.sin(latitudes)
+                        + np.cos(latitude) * np.cos(latitudes) * np.cos(longitudes - longitude))
+        return self.row_starts[r0] + np.flatnonzero(cos_distance >= np.cos(min(radius, np.pi)))
+
+    def stretch_counts(self, rows):
+        """
+        Returns, for the given rows, how many rectangle columns each valid
+        pixel is stretched to, as an (len(rows), equator_length) array whose
+        first pixel_lengths[row] entries are used. Follows the rounding of
+        SphereSurface.stretch_latitude, all rows at once.
+        """
+        rows = np.asarray(rows)
+        lengths = self.pixel_lengths[rows]
+        counts = np.zeros((len(rows), self.equator_length), dtype=np.int64)
+        elements_set = np.zeros(len(rows), dtype=np.int64)
+        for i in range(int(lengths.max(initial=0))):
+            active = np.flatnonzero(lengths > i)
+            remaining = self.equator_length - elements_set[active]
+            mul_factor = np.round(remaining / (lengths[active] - i)).astype(np.int64)
+            mul_factor = np.minimum(mul_factor, remaining)
+            counts[active, i] = mul_factor
+            elements_set[active] += mul_factor
+        return counts
+
+    def projection_rows(self, r0, r1, method="nearest"):
+        """
+        Computes the sphere -> rectangle resampling for rows r0..r1.
+        "nearest" returns an (r1 - r0, equator_length) array of compact
+        pixel indices matching stretch_latitude. "uniform" is the same kind
+        of map with each rectangle column sampling the pixel under its centre;
+        unlike "nearest" it costs O(1) per cell, which matters for bands of
+        very wide rows. "linear" returns (left, right, weight) so that a row
+        is left * (1 - weight) + right * weight, interpolating cyclically
+        along the latitude row.
+        """
+        rows = np.arange(r0, r1)
+        lengths = self.pixel_lengths[rows, None]
+        starts = self.row_starts[rows, None]
+        if method == "nearest":
+            counts = self.stretch_counts(rows)
+            used = np.arange(self.equator_length) < lengths
+            sources = (starts + np.arange(self.equator_length))[used]
+            return np.repeat(sources, counts[used]).reshape(len(rows), self.equator_length)
+        if method == "uniform":
+            return starts + (2 * np.arange(self.equator_length) + 1) * lengths // (2 * self.equator_length)
+        if method == "linear":
+            position = (np.arange(self.equator_length) + 0.5) * lengths / self.equator_length - 0.5
+            left = np.floor(position)
+            weight = (position - left).astype(np.float32)
+            left = left.astype(np.int64) % lengths
+            right = (left + 1) % lengths
+            return starts + left, starts + right, weight
+        raise ValueError(f"Unknown resampling method: {method}")
+
+    def projection(self, method="nearest", padded=True):
+        """
+        Returns the cached projection_rows() result for the whole sphere,
+        with indices into the padded surface array (surface.ravel()), or
+        compact indices when padded is False.
+        """
+        key = ("projection", method, padded)
+        if key not in self._tables:
+            projection = self.projection_rows(0, self.height, method)
+            if padded and method != "linear":
+                projection = self.flat_index[projection]
+            elif padded:
+                projection = (self.flat_index[projection[0]], self.flat_index[projection[1]], projection[2])
+            self._tables[key] = projection
+        return self._tables[key]
+
+    def sample_from(self, source):
+        """
+        Returns, for every compact pixel, the compact index of the pixel of
+        the source topology (another resolution) at the same position: the
+        row with the nearest latitude, and the pixel under the centre of the
+        same fraction of the row.
+        """
+        source_rows = np.rint(np.arange(self.height) * ((source.height - 1) / max(self.height - 1, 1))).astype(np.int64)
+        source_rows = source_rows[self.rows]
+        position = np.arange(self.size) - self.row_starts[self.rows]
+        source_position = (2 * position + 1) * source.pixel_lengths[source_rows] // (2 * self.pixel_lengths[self.rows])
+        return source.row_starts[source_rows] + source_position
+
+    def box_filter_band(self, values, y0, y1, size, dtype=np.float64):
+        """
+        SphereSurface.box_filter for rows y0..y1. values holds the compact
+        pixels of rows y0 - size // 2 .. y1 + size // 2 (clipped to the
+        sphere) in its last axis; leading axes are independent surfaces.
+        Returns the filtered pixels of rows y0..y1 as dtype, with integer
+        types rounded down.
+        """
+        if kernels.use_numba():
+            values = np.asarray(values)
+            flat_values = values.reshape(-1, values.shape[-1])
+            out = np.empty((len(flat_values), self.row_starts[y1] - self.row_starts[y0]), dtype=dtype)
+            for surface_values, surface_out in zip(flat_values, out):
+                kernels.box_filter_band(surface_values, y0, y1, size, self.pixel_lengths, self.pixel_offsets,
+                                        self.row_starts, self.equator_length, self.height,
+                                        np.issubdtype(dtype, np.integer), surface_out)
+            return out.reshape(values.shape[:-1] + (-1,))
+
+        half_size = size // 2
+        r0 = max(0, y0 - half_size)
+        r1 = min(self.height, y1 + half_size)
+        sums = self._row_window_sums(values, r0, r1, size)
+
+        # vertical pass over the horizontal sums of rows r0..r1
+        column_sums = np.zeros(sums.shape[:-2] + (r1 - r0 + 1, self.equator_length), dtype=np.float64)
+        np.cumsum(sums, axis=-2, out=column_sums[..., 1:, :])
+        rows = np.arange(y0, y1)
+        lo = np.maximum(rows - half_size, 0)
+        hi = np.minimum(rows + half_size + 1, self.height)
+        total = column_sums[..., hi - r0, :] - column_sums[..., lo - r0, :]
+        count = ((hi - lo) * size)[:, None]
+        if np.issubdtype(dtype, np.integer):
+            smoothed = np.floor_divide(total, count)
+        else:
+            smoothed = total / count
+        return smoothed[..., self.band_mask(y0, y1)].astype(dtype)
+
+    def _row_window_sums(self, values, r0, r1, size):
+        """
+        For the compact values of rows r0..r1 (last axis), sums a window of
+        `size` pixels centred on every padded column x, wrapping each window
+        around its row like SphereSurface.get() does. Returns a float64
+        array of shape (..., r1 - r0, equator_length).
+        """
+        lengths = self.pixel_lengths[r0:r1, None]
+        offsets = self.pixel_offsets[r0:r1, None]
+        starts = self.row_starts[r0:r1 + 1] - self.row_starts[r0]
+        count = values.shape[-1]
+
+        # every row stored twice in a row, so cyclic windows never wrap
+        rows = np.repeat(np.arange(r1 - r0), self.pixel_lengths[r0:r1])
+        position = starts[rows] + np.arange(count)
+        doubled = np.empty(values.shape[:-1] + (2 * count,), dtype=np.float64)
+        doubled[..., position] = values
+        doubled[..., position + self.pixel_lengths[r0:r1][rows]] = values
+        prefix = np.zeros(values.shape[:-1] + (2 * count + 1,), dtype=np.float64)
+        np.cumsum(doubled, axis=-1, out=prefix[..., 1:])
+
+        base = 2 * starts[:-1, None]
+        full_turns, rest = np.divmod(size, lengths)
+        row_totals = prefix[..., base + lengths] - prefix[..., base]
+        start = (np.arange(self.equator_length) - size // 2 - offsets) % lengths
+        return full_turns * row_totals + prefix[..., base + start + rest] - prefix[..., base + start]
+
+    def inverse_projection(self):
+        """
+        Returns, for every compact pixel, the flat index of the rectangle cell
+        at the middle of the run it is stretched to by the nearest projection.
+        """
+        key = ("inverse_projection",)
+        if key not in self._tables:
+            counts = self.stretch_counts(np.arange(self.height))
+            counts = counts[np.arange(self.equator_length) < self.pixel_lengths[:, None]]
+            starts = np.cumsum(counts) - counts
+            self._tables[key] = starts + np.maximum(counts - 1, 0) // 2
+        return self._tables[key]
+
+@functools.lru_cache(maxsize=8)
+def sphere_topology(equator_length):
+    """
+    Returns the shared SphereTopology for an equator length.
+    """
+    return SphereTopology(equator_length)
+
+class SphereSurface:
+    """
+    Pixel values on a sphere, stored as an (equator_length/2, equator_length)
+    array of which only the centred pixel_lengths[y] cells of each row are used.
+
+    With filename the storage is an np.memmap of that file (opened with
+    mode, "w+" creates it), for worlds that do not fit in memory. The
+    band-based methods (rows_values, box_filter, iter_rectangle, the
+    reductions) then only hold a few latitude rows in memory at a time.
+    """
+    padded_storage = True
+
+    def __init__(self, equator_length, dtype=np.uint8, filename=None, mode="w+"):
+        self.equator_length = equator_length
+        self.topology = sphere_topology(equator_length)
+        self.pixel_lengths = self.topology.pixel_lengths
+        self.pixel_offsets = self.topology.pixel_offsets
+        # uint8 by default; wider types for many plates or fine heights
+        self.dtype = np.dtype(dtype)
+        self.filename = filename
+        self._allocate(mode)
+
+    def _new_buffer(self, shape, mode):
+        if self.filename is None:
+            return np.zeros(shape, dtype=self.dtype)
+        return np.memmap(self.filename, dtype=self.dtype, mode=mode, shape=shape)
+
+    def _allocate(self, mode):
+        self.surface = self._new_buffer((self.topology.height, self.equator_length), mode)
+
+    def flush(self):
+        """
+        Writes memory-mapped storage back to its file.
+        """
+        if isinstance(self._flat_storage(), np.memmap):
+            self._flat_storage().flush()
+
+    def band_rows(self, band_rows=None):
+        """
+        Returns band_rows, or a default number of rows per band that keeps
+        band-sized temporaries around 1M cells.
+        """
+        if band_rows is None:
+            band_rows = (1 << 20) // self.equator_length
+        return max(1, int(band_rows))
+
+    def iter_bands(self, band_rows=None):
+        """
+        Yields (r0, r1) row ranges covering the sphere.
+        """
+        band_rows = self.band_rows(band_rows)
+        for r0 in range(0, self.topology.height, band_rows):
+            yield r0, min(r0 + band_rows, self.topology.height)
+
+    def rows_values(self, r0, r1):
+        """
+        Returns the valid pixels of rows r0..r1 in compact order.
+        """
+        return self.surface[r0:r1][self.topology.band_mask(r0, r1)]
+
+    def set_rows_values(self, r0, r1, values):
+        """
+        Sets the valid pixels of rows r0..r1 from compact-order values.
+        """
+        self.surface[r0:r1][self.topology.band_mask(r0, r1)] = values
+
+    def _flat_storage(self):
+        """
+        Returns the 1-D storage buffer that projection indices point into.
+        """
+        return self.surface.reshape(-1)
+
+    def values(self):
+        """
+        Returns the valid pixels as a 1-D array in compact (row-major) order.
+        """
+        return self.surface.reshape(-1)[self.topology.flat_index]
+
+    def set_values(self, values):
+        """
+        Sets the valid pixels from a 1-D array in compact order (or a scalar).
+        """
+        self.surface.reshape(-1)[self.topology.flat_index] = values
+
+    def row(self, y):
+        """
+        Returns a view of the valid pixels of latitude row y.
+        """
+        return self.surface[y, self.pixel_offsets[y]:self.pixel_offsets[y]+self.pixel_lengths[y]]
+
+    def padded(self):
+        """
+        Returns the surface as an (equator_length/2, equator_length) array.
+        """
+        return self.surface
 
     def latitude_pixel_lengths(self):
         """
@@ -14,20 +485,14 @@ class SphereSurface:
         The pixel length at latitude y is proportional to cos(theta),
         where theta is the latitude angle from the equator.
         """
-        latitudes = np.linspace(-np.pi/2, np.pi/2, np.round(self.equator_length/2).astype(int))
-        pixel_lengths = np.round(self.equator_length * np.cos(latitudes)).astype(int)
-        pixel_lengths[pixel_lengths < 1] = 1  # Ensure minimum length is 1
-        return pixel_lengths
+        return self.topology.pixel_lengths.copy()
     
     def latitude_pixel_offsets(self):
         """
         Returns a 1D numpy array of starting offsets for each latitude.
         The offset is calculated to center the pixels for each latitude.
         """
-        offsets = np.zeros(np.round(self.equator_length/2).astype(int), dtype=int)
-        for y in range(len(offsets)):
-            offsets[y] = (self.equator_length - self.pixel_lengths[y]) // 2
-        return offsets
+        return self.topology.pixel_offsets.copy()
 
     def push_front(self, arr, value, index, times):
         """
@@ -63,19 +528,40 @@ class SphereSurface:
             elements_set += mul_factor
         return stratched_row
 
-    def to_rectangle(self):
+    def to_rectangle(self, method="nearest"):
         """
         Transforms the sphere surface to a rectangle by stretching each latitude's
         pixels to the full equator_length.
-        Returns a new numpy array of shape (equator_length, equator_length).
-        """
-        rect = np.zeros((np.round(self.equator_length/2).astype(int), self.equator_length), dtype=np.uint8)
-        for y in range(np.round(self.equator_length/2).astype(int)):
-            src_row = self.surface[y, self.pixel_offsets[y]:self.pixel_offsets[y]+self.pixel_lengths[y]]
-            # Stretch src_row to equator_length
-            stretched_row = self.stretch_latitude(src_row, self.equator_length)
-            rect[y] = stretched_row
-        return rect
+        Returns a new numpy array of shape (equator_length/2, equator_length).
+        "nearest" duplicates pixels exactly like stretch_latitude, "linear"
+        interpolates along each latitude row.
+        The resampling indices are cached per equator_length.
+        """
+        flat_surface = self._flat_storage()
+        if method == "nearest":
+            projection = self.topology.projection("nearest", self.padded_storage)
+            if kernels.use_numba():
+                rect = np.empty(projection.shape, dtype=flat_surface.dtype)
+                kernels.gather_rows(np.asarray(flat_surface), projection, rect)
+                return rect
+            return flat_surface[projection]
+        left, right, weight = self.topology.projection(method, self.padded_storage)
+        if kernels.use_numba():
+            rect = np.empty(left.shape, dtype=flat_surface.dtype)
+            kernels.interpolate_rows(np.asarray(flat_surface), left, right, weight,
+                                     np.issubdtype(flat_surface.dtype, np.integer), rect)
+            return rect
+        rect = flat_surface[left] * (1 - weight) + flat_surface[right] * weight
+        if np.issubdtype(flat_surface.dtype, np.integer):
+            rect = np.rint(rect)
+        return rect.astype(flat_surface.dtype)
+
+    def from_rectangle(self, rect):
+        """
+        Inverse of to_rectangle: sets every valid pixel from the rectangle
+        cell at the middle of the run it was stretched to.
+        """
+        self.set_values(np.asarray(rect).reshape(-1)[self.topology.inverse_projection()])
     
     def to_rectangle2(self):
         """
@@ -83,28 +569,48 @@ class SphereSurface:
         """
         return self.surface
 
+    def iter_rectangle(self, band_rows=None, method=None):
+        """
+        Yields (y0, rect_rows): to_rectangle() computed band by band without
+        any full-size index map, so memory stays bounded by the band size.
+        See SphereTopology.projection_rows for the methods. By default
+        "nearest" is used up to NEAREST_STREAM_MAX_LENGTH, so the bands
+        are exactly to_rectangle(); larger spheres use "uniform", which
+        can pick a neighbouring pixel of the same row for some cells.
+        """
+        topology = self.topology
+        if method is None:
+            method = "nearest" if self.equator_length <= NEAREST_STREAM_MAX_LENGTH else "uniform"
+        for y0, y1 in self.iter_bands(band_rows):
+            values = self.rows_values(y0, y1)
+            base = topology.row_starts[y0]
+            if method == "linear":
+                left, right, weight = topology.projection_rows(y0, y1, method)
+                rect = values[left - base] * (1 - weight) + values[right - base] * weight
+                if np.issubdtype(self.dtype, np.integer):
+                    rect = np.rint(rect)
+                yield y0, rect.astype(self.dtype)
+            else:
+                yield y0, values[topology.projection_rows(y0, y1, method) - base]
+
     def count_nonzero(self):
         """
-        Counts the number of pixels equal to 'value' within the valid pixel range for each latitude.
+        Counts the nonzero pixels within the valid pixel range for each latitude.
         """
-        count = 0
-        for y in range(np.round(self.equator_length/2).astype(int)):
-            count += np.count_nonzero(self.surface[y][self.pixel_offsets[y]:self.pixel_offsets[y]+self.pixel_lengths[y]])
-        return count
+        return sum(int(np.count_nonzero(self.rows_values(r0, r1))) for r0, r1 in self.iter_bands())
 
     def size(self):
         """
         Returns the total number of valid pixels on the sphere surface.
         """
-        return int(np.sum(self.pixel_lengths))
+        return self.topology.size
     
     def set_surface_default(self, value):
         """
-        Sets the surface to a default pattern for testing.
+        Sets every valid pixel to value.
         """
-        for y in range(np.round(self.equator_length/2).astype(int)):
-            length = self.pixel_lengths[y]
-            self.surface[y, self.pixel_offsets[y]:self.pixel_offsets[y]+length] = value
+        for r0, r1 in self.iter_bands():
+            self.set_rows_values(r0, r1, value)
 
     def get_min_max(self):
         """
@@ -112,46 +618,62 @@ class SphereSurface:
         """
         mn = None
         mx = None
-        for y in range(np.round(self.equator_length/2).astype(int)):
-            length = self.pixel_lengths[y]
-            row = self.surface[y, self.pixel_offsets[y]:self.pixel_offsets[y]+length]
-            row_min = row.min()
-            row_max = row.max()
-            if mn is None or row_min < mn:
-                mn = row_min
-            if mx is None or row_max > mx:
-                mx = row_max
+        for r0, r1 in self.iter_bands():
+            values = self.rows_values(r0, r1)
+            if mn is None or values.min() < mn:
+                mn = values.min()
+            if mx is None or values.max() > mx:
+                mx = values.max()
         return mn, mx
     
     def get(self, lon, lat):
         """
         Get the pixel value at the specified longitude and latitude.
         """
-        longitude = lon % np.round(self.equator_length/2).astype(int)
-        if lat < self.pixel_offsets[longitude]:
-            end_lat = self.pixel_offsets[longitude] + self.pixel_lengths[longitude]
-            negative_offset = self.pixel_offsets[longitude] - lat
-            latitude = end_lat - negative_offset
-        elif lat >= self.pixel_offsets[longitude] + self.pixel_lengths[longitude]:
-            latitude = ((lat - self.pixel_offsets[longitude]) % self.pixel_lengths[longitude]) + self.pixel_offsets[longitude]
-        else:
-            latitude = lat
-        return self.surface[longitude, latitude]
+        longitude = lon % self.topology.height
+        return self.surface[longitude, self.topology.wrap(longitude, lat)]
     
     def set(self, lon, lat, value):
         """
-        Get the pixel value at the specified longitude and latitude.
+        Set the pixel value at the specified longitude and latitude.
         """
-        longitude = lon % np.round(self.equator_length/2).astype(int)
-        if lat < self.pixel_offsets[longitude]:
-            end_lat = self.pixel_offsets[longitude] + self.pixel_lengths[longitude]
-            negative_offset = self.pixel_offsets[longitude] - lat
-            latitude = end_lat - negative_offset
-        elif lat >= self.pixel_offsets[longitude] + self.pixel_lengths[longitude]:
-            latitude = ((lat - self.pixel_offsets[longitude]) % self.pixel_lengths[longitude]) + self.pixel_offsets[longitude]
-        else:
-            latitude = lat
-        self.surface[longitude, latitude] = value
+        longitude = lon % self.topology.height
+        self.surface[longitude, self.topology.wrap(longitude, lat)] = value
+
+    def _storage_index(self, rows, cols):
+        # index into _flat_storage() of (row, column) after wrapping the column
+        return rows * self.equator_length + self.topology.wrap(rows, cols)
+
+    def get_many(self, lon, lat):
+        """
+        Vectorized get(): returns the values at arrays of coordinates, with
+        the same wrapping (lon is taken modulo the number of rows, then lat
+        is wrapped around that row).
+        """
+        longitude = np.asarray(lon) % self.topology.height
+        return self._flat_storage()[self._storage_index(longitude, np.asarray(lat))]
+
+    def set_many(self, lon, lat, value):
+        """
+        Vectorized set(): sets the values at arrays of coordinates (value may
+        be a scalar or an array of the same shape). Where coordinates repeat
+        the last value wins.
+        """
+        longitude = np.asarray(lon) % self.topology.height
+        self._flat_storage()[self._storage_index(longitude, np.asarray(lat))] = value
+
+    def get_pixels(self, pixels):
+        """
+        Returns the values at compact pixel indices, e.g. from
+        topology.pixels_in_rectangle() or topology.pixels_within().
+        """
+        return self._flat_storage()[self.topology.flat_index[pixels]]
+
+    def set_pixels(self, pixels, value):
+        """
+        Sets the values at compact pixel indices.
+        """
+        self._flat_storage()[self.topology.flat_index[pixels]] = value
 
     def square_filter(self, lon, lat, size):
         """
@@ -163,11 +685,117 @@ class SphereSurface:
         count = 0
         for dlon in range(-half_size, half_size + 1):
             for dlat in range(-half_size, half_size + 1):
-                if (lon + dlon) < 0 or (lon + dlon) > self.equator_length/2:
+                if (lon + dlon) < 0 or (lon + dlon) >= self.topology.height:
                     continue
-                total += int(self.get(lon + dlon, lat + dlat))
+                total += self.get(lon + dlon, lat + dlat).item()
                 count += 1
-        return total // count
+        if np.issubdtype(self.dtype, np.integer):
+            return total // count
+        return total / count
+
+    def box_filter(self, size, band_rows=None, out=None):
+        """
+        Applies square_filter of the given (odd) size to every valid pixel.
+        Returns the filtered pixels as a new 1-D array in compact order, or
+        writes them into the surface out (which may be self) and returns it.
+
+        Each row is turned into cyclic prefix sums, so a window costs two
+        lookups per pixel in the horizontal pass and two in the vertical pass,
+        whatever its size. Rows are processed in bands of band_rows output rows
+        (plus size // 2 halo rows on each side), and a band is written only
+        once no later band reads its rows, so memory stays bounded and
+        filtering in place is safe.
+        """
+        topology = self.topology
+        half_size = size // 2
+        result = np.empty(topology.size, dtype=self.dtype) if out is None else None
+        out_dtype = self.dtype if out is None else out.dtype
+
+        pending = []
+        for y0, y1 in self.iter_bands(band_rows):
+            values = self.rows_values(max(0, y0 - half_size), min(topology.height, y1 + half_size))
+            pending.append((y0, y1, topology.box_filter_band(values, y0, y1, size, out_dtype)))
+
+            # the next band reads rows from y1 - half_size on
+            while pending and (pending[0][1] <= y1 - half_size or y1 == topology.height):
+                b0, b1, band = pending.pop(0)
+                if out is None:
+                    result[topology.row_starts[b0]:topology.row_starts[b1]] = band
+                else:
+                    out.set_rows_values(b0, b1, band)
+        return result if out is None else out
+
+class RaggedSphereSurface(SphereSurface):
+    """
+    SphereSurface that keeps only the valid pixels, row after row, in one
+    contiguous 1-D buffer (self.data); row y starts at topology.row_starts[y].
+    Uses about a third less memory than the padded array and whole-surface
+    reductions work directly on the buffer.
+
+    A padded array cannot be expressed as a strided view of the buffer, so
+    `surface` and padded() build a read-only padded copy on demand; use
+    row() or values() for zero-copy access.
+    """
+    padded_storage = False
+
+    def _allocate(self, mode):
+        self.data = self._new_buffer((self.topology.size,), mode)
+
+    @property
+    def surface(self):
+        return self.padded()
+
+    @surface.setter
+    def surface(self, value):
+        self.data[:] = np.asarray(value).reshape(-1)[self.topology.flat_index]
+
+    def _flat_storage(self):
+        return self.data
+
+    def values(self):
+        return self.data
+
+    def set_values(self, values):
+        self.data[:] = values
+
+    def row(self, y):
+        start = self.topology.row_starts[y]
+        return self.data[start:start+self.pixel_lengths[y]]
+
+    def rows_values(self, r0, r1):
+        return self.data[self.topology.row_starts[r0]:self.topology.row_starts[r1]]
+
+    def set_rows_values(self, r0, r1, values):
+        self.data[self.topology.row_starts[r0]:self.topology.row_starts[r1]] = values
+
+    def padded(self):
+        padded = np.zeros((self.topology.height, self.equator_length), dtype=self.dtype)
+        padded.reshape(-1)[self.topology.flat_index] = self.data
+        padded.flags.writeable = False
+        return padded
+
+    def _storage_index(self, rows, cols):
+        return self.topology.compact(rows, cols)
+
+    def get_pixels(self, pixels):
+        return self.data[pixels]
+
+    def set_pixels(self, pixels, value):
+        self.data[pixels] = value
+
+    def get(self, lon, lat):
+        longitude = lon % self.topology.height
+        return self.data[self.topology.compact(longitude, lat)]
+
+    def set(self, lon, lat, value):
+        longitude = lon % self.topology.height
+        self.data[self.topology.compact(longitude, lat)] = value
+
+# Surface classes selectable by name
+SURFACE_STORAGES = {
+    "padded": SphereSurface,
+    "ragged": RaggedSphereSurface,
+}
 
 # Example usage:
 # sphere = SphereSurface(512)
@@ -0,0 +1,149 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from tectonic_plates import TectonicPlates
+from heigth_map import HeightMap
+
+# Bump when the stored arrays or the generation algorithm change
+CACHE_VERSION = 3
+
+class StageCache:
+    """
+    Content-addressed on-disk cache for generation stages.
+
+    Each entry is a compressed .npz named after a hash of the stage name and
+    its parameters. Reading an entry refreshes its modification time; once
+    the directory grows past max_bytes the least recently used entries are
+    deleted.
+    """
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, stage, **params):
+        """
+        Returns the cache key for a stage and its (JSON-serialisable) parameters.
+        """
+        payload = json.dumps({"version": CACHE_VERSION, "stage": stage, **params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        """
+        Returns the stored dict of arrays, or None if the key is not cached.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # unreadable entry, e.g. left over from a crash: drop it
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return arrays
+
+    def store(self, key, arrays):
+        """
+        Stores a dict of arrays under key, then evicts old entries.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            with contextlib.suppress(OSError):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == f"{keep}.npz":
+                continue
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+
+def cached_plates(cache, equator_length, num_continental, num_oceanic, seed, growth_rate_range=3, storage="padded",
+                  instrumentation=None, coarse=None):
+    """
+    Returns (plates, key): a grown TectonicPlates, loaded from the cache when
+    the same parameters were generated before. seed must be an int.
+    With coarse (plates returned by cached_plates for the same parameters
+    at a lower equator length) the plates are coarse.refine()d instead of
+    grown from scratch.
+    """
+    params = {}
+    if coarse is not None:
+        params["coarse_equator_length"] = coarse.equator_length
+    key = cache.key(
+        "plates",
+        equator_length=equator_length,
+        num_continental=num_continental,
+        num_oceanic=num_oceanic,
+        seed=int(seed),
+        growth_rate_range=growth_rate_range,
+        **params,
+    )
+    arrays = cache.load(key)
+    if arrays is not None:
+        return TectonicPlates.from_arrays(arrays, storage=storage, instrumentation=instrumentation), key
+
+    if coarse is not None:
+        plates = coarse.refine(equator_length, storage=storage, instrumentation=instrumentation)
+    else:
+        plates = TectonicPlates(equator_length, num_continental, num_oceanic,
+                                growth_rate_range=growth_rate_range, storage=storage, seed=int(seed),
+                                instrumentation=instrumentation)
+        plates.draw_plates()
+    cache.store(key, plates.to_arrays())
+    return plates, key
+
+def cached_heightmap(cache, plates, plates_key, base_ocean=20, base_continent=60, smooth_window=3, dtype=np.float32,
+                     boundary_terrain=False):
+    """
+    Returns a HeightMap for plates (as returned by cached_plates with
+    plates_key), loaded from the cache when it was computed before.
+    """
+    key = cache.key(
+        "heights",
+        plates=plates_key,
+        base_ocean=int(base_ocean),
+        base_continent=int(base_continent),
+        smooth_window=int(smooth_window),
+        dtype=np.dtype(dtype).str,
+        boundary_terrain=bool(boundary_terrain),
+    )
+    arrays = cache.load(key)
+    if arrays is not None:
+        return HeightMap.from_arrays(plates, arrays)
+
+    hmap = HeightMap(plates, base_ocean=base_ocean, base_continent=base_continent,
+                     smooth_window=smooth_window, dtype=dtype, boundary_terrain=boundary_terrain)
+    cache.store(key, hmap.to_arrays())
+    return hmap
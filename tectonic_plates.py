@@ -1,5 +1,11 @@
+import json
+
 import numpy as np
-from sphere_surface import SphereSurface
+from sphere_surface import SURFACE_STORAGES
+from instrumentation import NO_INSTRUMENTATION
+import kernels
+from png_writer import write_png
+from tile_export import TilePyramidWriter
 from PIL import Image
 import time
 
@@ -10,113 +16,407 @@ class Plate:
         self.longitude = longitude
         self.plate_type = plate_type  # 'continental' or 'oceanic'
         self.growth_rate = growth_rate
-        self.points = set()   # Holds all points belonging to this plate
-        self.borders = set()  # Holds border points for this plate
-        self.old_borders = set()  # Holds border points for this plate
+        self.angular_velocity = np.zeros(3)  # Euler pole rotation (x, y, z), radians per step
+        self.borders = np.empty(0, dtype=np.int64)  # Current growth frontier (compact indices)
+
+class PlateIndex:
+    """
+    Per-plate statistics computed from a label grid in one vectorized pass.
+
+    Per-plate arrays are indexed by plate id (entry 0 is the unlabelled
+    background):
+    - area: number of pixels
+    - centroid_latitude, centroid_longitude: radians, from the mean of the
+      pixels' unit vectors (NaN for empty plates)
+    - min_row, max_row: latitude band covered by the plate (-1 when empty)
+    Boundaries (4-connected, between different labels):
+    - boundary: int32 compact indices of boundary pixels (either end of a
+      link between different labels), grouped by plate id;
+      boundary_ptr[pid]:boundary_ptr[pid+1] is the slice of plate pid
+    - adjacency: int32 (M, 2) unique pairs (a, b), a < b, of touching plates
+    - adjacency_length: number of neighbour links between a pixel of a and
+      one of b, in either direction
+    """
+    def __init__(self, topology, labels, num_ids):
+        labels = labels.astype(np.int64)
+        rows = topology.rows
+
+        self.area = np.bincount(labels, minlength=num_ids)
+
+        latitudes, longitudes = topology.coordinates()
+        cos_lat = np.cos(latitudes)
+        x = np.bincount(labels, weights=cos_lat * np.cos(longitudes), minlength=num_ids)
+        y = np.bincount(labels, weights=cos_lat * np.sin(longitudes), minlength=num_ids)
+        z = np.bincount(labels, weights=np.sin(latitudes), minlength=num_ids)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.centroid_latitude = np.arctan2(z, np.hypot(x, y))
+            self.centroid_longitude = np.arctan2(y, x)
+        self.centroid_latitude[self.area == 0] = np.nan
+        self.centroid_longitude[self.area == 0] = np.nan
+
+        self.min_row = np.full(num_ids, topology.height, dtype=np.int64)
+        self.max_row = np.full(num_ids, -1, dtype=np.int64)
+        np.minimum.at(self.min_row, labels, rows)
+        np.maximum.at(self.max_row, labels, rows)
+        self.min_row[self.area == 0] = -1
+
+        neighbour_ptr, neighbours = topology.neighbours()
+        sources = np.repeat(np.arange(topology.size, dtype=np.int32), np.diff(neighbour_ptr))
+        different = labels[sources] != labels[neighbours]
+        sources = sources[different]
+        targets = neighbours[different]
+
+        # links between rows of different lengths only go one way, so a pixel
+        # can be on a boundary as the target of a link only
+        boundary = np.unique(np.concatenate((sources, targets)))
+        order = np.argsort(labels[boundary], kind="stable")
+        self.boundary = boundary[order].astype(np.int32)
+        self.boundary_ptr = np.zeros(num_ids + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels[self.boundary], minlength=num_ids), out=self.boundary_ptr[1:])
+
+        # a pair may only be linked in one direction: count links both ways as (min, max)
+        a = labels[sources]
+        b = labels[targets]
+        pair_codes = np.minimum(a, b) * num_ids + np.maximum(a, b)
+        codes, self.adjacency_length = np.unique(pair_codes, return_counts=True)
+        self.adjacency = np.stack(np.divmod(codes, num_ids), axis=1).astype(np.int32)
+
+    def boundary_of(self, plate_id):
+        """
+        Returns the compact indices of the boundary pixels of one plate.
+        """
+        return self.boundary[self.boundary_ptr[plate_id]:self.boundary_ptr[plate_id + 1]]
+
+    def neighbours_of(self, plate_id):
+        """
+        Returns the ids of the plates touching plate_id.
+        """
+        pairs = self.adjacency
+        return np.concatenate((pairs[pairs[:, 0] == plate_id, 1], pairs[pairs[:, 1] == plate_id, 0]))
+
+# Each stage draws from its own generator so it can be recomputed on its own
+STAGES = ("seeding", "growth", "colouring", "motion")
+
+def stage_seeds(seed=None):
+    """
+    Derives one SeedSequence per stage in STAGES from seed, which may be an
+    int, a SeedSequence, a numpy Generator (one value is drawn from it) or
+    None for fresh entropy.
+    """
+    if isinstance(seed, np.random.Generator):
+        seed = int(seed.integers(0, 2**63))
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed, dict(zip(STAGES, seed.spawn(len(STAGES))))
+
+def seed_entropy(sequence):
+    """
+    Returns the entropy of a SeedSequence (an int or a sequence of ints) as
+    JSON text, for storing; seed_sequence() reads it back.
+    """
+    entropy = sequence.entropy
+    if isinstance(entropy, (int, np.integer)):
+        return json.dumps(int(entropy))
+    return json.dumps([int(word) for word in entropy])
+
+def seed_sequence(entropy, spawn_key):
+    """
+    Rebuilds a SeedSequence from seed_entropy() text and its spawn key.
+    """
+    return np.random.SeedSequence(json.loads(entropy), spawn_key=tuple(int(k) for k in spawn_key))
+
+def seed_plates(topology, stage_seeds, num_continental, num_oceanic, growth_rate_range=3):
+    """
+    Draws the plate table: one Plate per id, continental ones first, with a
+    random seed pixel (from the "seeding" stage) and growth rate (from the
+    "growth" stage) for each.
+    """
+    seeding = np.random.default_rng(stage_seeds["seeding"])
+    growth = np.random.default_rng(stage_seeds["growth"])
+    plates = []
+    for i in range(num_continental + num_oceanic):
+        # Random latitude and longitude indices on the sphere surface
+        longitude = seeding.integers(0, topology.height-1)
+        latitude = seeding.integers(topology.pixel_offsets[longitude], topology.pixel_offsets[longitude]+topology.pixel_lengths[longitude])
+        growth_rate = int(growth.integers(1, growth_rate_range))
+        plate_type = 'continental' if i < num_continental else 'oceanic'
+        plates.append(Plate(i + 1, latitude, longitude, plate_type, growth_rate))
+    return plates
 
 class TectonicPlates:
-    def __init__(self, equator_length, num_continental, num_oceanic, growth_rate_range=3):
-        self.surface = SphereSurface(equator_length)
+    def __init__(self, equator_length, num_continental, num_oceanic, growth_rate_range=3, storage="padded", dtype=None, seed=None,
+                 filename=None, instrumentation=None):
+        # plate labels: smallest unsigned type that holds every plate id unless given
+        if dtype is None:
+            dtype = np.min_scalar_type(num_continental + num_oceanic)
+        if num_continental + num_oceanic > np.iinfo(dtype).max:
+            raise ValueError(f"{num_continental + num_oceanic} plates do not fit in {np.dtype(dtype).name} labels")
+        # filename: keep the labels in a memory-mapped file (large worlds)
+        self.surface = SURFACE_STORAGES[storage](equator_length, dtype=dtype, filename=filename)
         self.equator_length = equator_length
+        self.seed_sequence, self.stage_seeds = stage_seeds(seed)
         self.plates = []
-        self._init_plates(num_continental, num_oceanic, growth_rate_range)
+        self._plate_index = None
+        # receives stage timings and growth progress (see instrumentation.py)
+        self.instrumentation = instrumentation or NO_INSTRUMENTATION
+        with self.instrumentation.stage("seeding", pixels=num_continental + num_oceanic):
+            self._init_plates(num_continental, num_oceanic, growth_rate_range)
+            self._init_motion()
 
-    def _random_point(self):
-        # Random latitude and longitude indices on the sphere surface
-        longitude = np.random.randint(0, np.round(self.equator_length/2).astype(int)-1)
-        latitude = np.random.randint(self.surface.pixel_offsets[longitude], self.surface.pixel_offsets[longitude]+self.surface.pixel_lengths[longitude])
-        return longitude, latitude
+    def to_arrays(self):
+        """
+        Returns the label grid (compact order) and the plate table as a dict
+        of arrays for np.savez; from_arrays() rebuilds the instance.
+        """
+        return {
+            "equator_length": np.array(self.equator_length),
+            "labels": self.surface.values(),
+            "plate_ids": np.array([p.plate_id for p in self.plates], dtype=np.int64),
+            "continental": np.array([p.plate_type == 'continental' for p in self.plates], dtype=bool),
+            "growth_rates": np.array([p.growth_rate for p in self.plates], dtype=np.int64),
+            "seed_longitudes": np.array([p.longitude for p in self.plates], dtype=np.int64),
+            "seed_latitudes": np.array([p.latitude for p in self.plates], dtype=np.int64),
+            "seed_entropy": np.array(seed_entropy(self.seed_sequence)),
+            "seed_spawn_key": np.array(self.seed_sequence.spawn_key, dtype=np.int64),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, storage="padded", instrumentation=None):
+        """
+        Rebuilds a grown TectonicPlates from to_arrays() output without
+        drawing seeds or growing again.
+        """
+        plates = cls.__new__(cls)
+        plates.instrumentation = instrumentation or NO_INSTRUMENTATION
+        plates.equator_length = int(arrays["equator_length"])
+        plates.surface = SURFACE_STORAGES[storage](plates.equator_length, dtype=arrays["labels"].dtype)
+        plates.surface.set_values(arrays["labels"])
+        seed = seed_sequence(str(arrays["seed_entropy"]), arrays["seed_spawn_key"])
+        plates.seed_sequence, plates.stage_seeds = stage_seeds(seed)
+        plates._plate_index = None
+        plates.plates = [
+            Plate(int(pid), int(lat), int(lon), 'continental' if continental else 'oceanic', int(rate))
+            for pid, lat, lon, continental, rate in zip(
+                arrays["plate_ids"], arrays["seed_latitudes"], arrays["seed_longitudes"],
+                arrays["continental"], arrays["growth_rates"],
+            )
+        ]
+        plates._init_motion()
+        return plates
+
+    def rng(self, stage):
+        """
+        Returns a fresh Generator for one of STAGES; the same stage always
+        yields the same draws for a given seed.
+        """
+        return np.random.default_rng(self.stage_seeds[stage])
 
     def _init_plates(self, num_continental, num_oceanic, growth_rate_range):
-        for i in range(num_continental):
-            lon, lat = self._random_point()
-            growth_rate = np.random.randint(1, growth_rate_range)
-            self.plates.append(Plate(i + 1, lat, lon, 'continental', growth_rate))
-        for i in range(num_oceanic):
-            lon, lat = self._random_point()
-            growth_rate = np.random.randint(1, growth_rate_range)
-            self.plates.append(Plate(num_continental + i + 1, lat, lon, 'oceanic', growth_rate))
+        self.plates = seed_plates(self.surface.topology, self.stage_seeds, num_continental, num_oceanic, growth_rate_range)
+
+    def _init_motion(self):
+        # Each plate rotates about a random Euler pole
+        motion = self.rng("motion")
+        for plate in self.plates:
+            axis = motion.normal(size=3)
+            plate.angular_velocity = axis / np.linalg.norm(axis) * motion.uniform(0.5, 1.0)
+
+    def boundary_convergence(self):
+        """
+        Returns, for every pair in plate_index().adjacency, how fast the two
+        plates approach each other at the midpoint between their centroids:
+        positive for convergent boundaries, negative for divergent ones.
+        """
+        index = self.plate_index()
+        a, b = index.adjacency[:, 0], index.adjacency[:, 1]
+        lat, lon = index.centroid_latitude, index.centroid_longitude
+        centroids = np.stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)), axis=1)
+        omega = self.lookup_table([plate.angular_velocity for plate in self.plates], background=0.0, dtype=np.float64)
+
+        midpoint = centroids[a] + centroids[b]
+        midpoint /= np.maximum(np.linalg.norm(midpoint, axis=1, keepdims=True), 1e-12)
+        relative_velocity = np.cross(omega[a] - omega[b], midpoint)
+        direction = centroids[b] - centroids[a]
+        direction /= np.maximum(np.linalg.norm(direction, axis=1, keepdims=True), 1e-12)
+        return np.einsum("ij,ij->i", relative_velocity, direction)
+
+    def _grow(self, labels, frontier, plate_id):
+        """
+        Expands a frontier of compact pixels by one pixel in every direction.
+        Returns the newly claimed pixels.
+        """
+        topology = self.surface.topology
+        if kernels.use_numba():
+            # claimed in discovery order rather than sorted; the labels are the same
+            neighbour_ptr, neighbours = topology.neighbours()
+            return kernels.grow(neighbour_ptr, neighbours, np.asarray(labels), frontier, plate_id)
+        _, candidates = topology.neighbours_of(frontier)
+        claimed = np.unique(candidates[labels[candidates] == 0])
+        labels[claimed] = plate_id
+        return claimed
 
     def draw_plates(self):
-        surface = self.surface.surface
+        topology = self.surface.topology
+        labels = self.surface.values()
 
         # Initialize plate seeds
         for plate in self.plates:
-            if surface[plate.longitude, plate.latitude] == 0:
-                surface[plate.longitude, plate.latitude] = plate.plate_id
-                plate.points.add((plate.longitude, plate.latitude))
-                plate.borders.add((plate.longitude, plate.latitude))
+            seed = topology.compact(plate.longitude, plate.latitude)
+            plate.borders = np.empty(0, dtype=np.int64)
+            if labels[seed] == 0:
+                labels[seed] = plate.plate_id
+                plate.borders = np.array([seed], dtype=np.int64)
 
-        # Directions: S, N, E, W, 
-        directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+        self._grow_frontiers(labels)
 
-        
+    def _grow_frontiers(self, labels):
+        """
+        Grows every plate from its borders, growth_rate pixels per step in
+        turn, until no free pixel (label 0) can be reached. Stores labels.
+        """
+        instrumentation = self.instrumentation
         step = 0
-        total_pixels = self.surface.size()
-        free_pixels = total_pixels - self.surface.count_nonzero()
-        print(f"Starting plate growth: {free_pixels} free pixels")
+        total_pixels = self.surface.topology.size
+        free_pixels = total_pixels - int(np.count_nonzero(labels))
+
+        with instrumentation.stage("growth", pixels=free_pixels):
+            previous_round_free = free_pixels
+            while free_pixels > 0:
+                step += 1
+                for plate in self.plates:
+                    for g in range(plate.growth_rate):
+                        if len(plate.borders) == 0:
+                            break
+                        claimed = self._grow(labels, plate.borders, plate.plate_id)
+                        plate.borders = claimed
+                        free_pixels -= len(claimed)
+                if instrumentation.enabled:
+                    instrumentation.event(
+                        "growth_step",
+                        step=step,
+                        free_pixels=free_pixels,
+                        total_pixels=total_pixels,
+                        frontier_pixels=sum(len(plate.borders) for plate in self.plates),
+                        claimed_pixels=previous_round_free - free_pixels,
+                    )
+                if free_pixels == previous_round_free:
+                    # no more growth possible
+                    break
+                else: 
+                    previous_round_free = free_pixels
+            self.surface.set_values(labels)
+        self._plate_index = None
+
+    def refine(self, equator_length, band=1, storage=None, filename=None, instrumentation=None):
+        """
+        Returns a TectonicPlates at a higher equator_length built from this
+        grown (coarse) one, for coarse-to-fine previews: the labels are
+        upsampled and only the pixels within band coarse pixels of a plate
+        boundary are grown again, so the result matches this map away from
+        the boundaries. Plates that lie entirely within the band restart
+        from their seed pixel, so every plate of this map is kept. Seeds,
+        growth rates, colours and motion are shared with this instance.
+        """
+        topology = self.surface.topology
+        if storage is None:
+            storage = "padded" if self.surface.padded_storage else "ragged"
+
+        fine = TectonicPlates.__new__(TectonicPlates)
+        fine.equator_length = equator_length
+        fine.surface = SURFACE_STORAGES[storage](equator_length, dtype=self.surface.dtype, filename=filename)
+        fine.seed_sequence, fine.stage_seeds = self.seed_sequence, self.stage_seeds
+        fine.instrumentation = instrumentation or self.instrumentation
+        fine._plate_index = None
+        fine_topology = fine.surface.topology
+
+        with fine.instrumentation.stage("refinement", pixels=fine_topology.size):
+            samples = fine_topology.sample_from(topology)
+            coarse_labels = self.surface.values()[samples]
+            labels = coarse_labels.copy()
+
+            # free everything near a boundary, found on the (much smaller) coarse map
+            boundary = self.plate_index().boundary
+            if len(boundary):
+                near_boundary = topology.distance_from(boundary, max_distance=band - 1) >= 0
+                labels[near_boundary[samples]] = 0
+
+            # regrow from the labelled pixels that touch a free one
+            sources, targets = fine_topology.neighbours_of(np.flatnonzero(labels == 0))
+            frontier = np.unique(targets[labels[targets] != 0])
+            frontier_labels = labels[frontier]
 
-        previous_round_free = free_pixels
-        while free_pixels > 0:
-            step += 1
+            fine.plates = []
+            area = self.plate_index().area
+            rows = np.rint(np.arange(topology.height) * ((fine_topology.height - 1) / max(topology.height - 1, 1)))
             for plate in self.plates:
-                for g in range(plate.growth_rate):
-                    new_borders = set()
-                    for point in plate.borders:
-                        lon, lat = point
-                        taken_bits_encountered = 0
-                        for dlon, dlat in directions:
-                            nlon = lon + dlon
-                            if 0 <= nlon < np.round(self.equator_length/2).astype(int):
-                                nlat = (lat + dlat)
-                                if nlat < self.surface.pixel_offsets[nlon]:
-                                    end_lat = self.surface.pixel_offsets[nlon] + self.surface.pixel_lengths[nlon]
-                                    negative_offset = self.surface.pixel_offsets[nlon] - nlat
-                                    nlat = end_lat - negative_offset
-                                elif nlat >= self.surface.pixel_offsets[nlon] + self.surface.pixel_lengths[nlon]:
-                                    nlat = nlat % self.surface.pixel_lengths[nlon] + self.surface.pixel_offsets[nlon]
-                                if surface[nlon, nlat] == 0:
-                                    surface[nlon, nlat] = plate.plate_id
-                                    new_borders.add((nlon, nlat))
-                                else:
-                                    taken_bits_encountered += 1
-                        if taken_bits_encountered > 0:
-                            plate.old_borders.add(point)
-                    plate.borders = new_borders
-                    plate.points.update(new_borders)
-            free_pixels = total_pixels - self.surface.count_nonzero()
-            print(f"Step {step}: {free_pixels} free pixels remaining ({100 * (total_pixels - free_pixels) // total_pixels}%)")
-            # time.sleep(1)  # Slow down for visibility
-            if free_pixels == previous_round_free:
-                print("No more growth possible, stopping.")
-                break
-            else: 
-                previous_round_free = free_pixels
-        print("Plate growth complete.")
+                row = int(rows[plate.longitude])
+                position = (plate.latitude - topology.pixel_offsets[plate.longitude] + 0.5) / topology.pixel_lengths[plate.longitude]
+                column = fine_topology.pixel_offsets[row] + int(position * fine_topology.pixel_lengths[row])
+                fine_plate = Plate(plate.plate_id, int(column), row, plate.plate_type, plate.growth_rate)
+                fine_plate.angular_velocity = plate.angular_velocity
+                fine_plate.borders = frontier[frontier_labels == plate.plate_id]
+                if len(fine_plate.borders) == 0 and area[plate.plate_id] > 0:
+                    # the whole plate was near a boundary: restart it from its seed,
+                    # or from its coarse area if another plate kept the seed pixel
+                    seed = fine_topology.compact(row, column)
+                    if labels[seed] == 0:
+                        fine_plate.borders = np.array([seed], dtype=np.int64)
+                    else:
+                        fine_plate.borders = np.flatnonzero((coarse_labels == plate.plate_id) & (labels == 0))
+                    labels[fine_plate.borders] = plate.plate_id
+                fine.plates.append(fine_plate)
 
-    def surface_to_image(self):
+        if not labels.any():
+            # nothing survived the boundary band: grow the fine map from scratch
+            fine.draw_plates()
+            return fine
+        fine._grow_frontiers(labels)
+        return fine
+
+    def plate_index(self):
         """
-        Converts the sphere surface to a rectangle and returns it as an image.
-        Each plate ID is assigned a distinguishable color.
+        Returns the PlateIndex (areas, centroids, latitude bands, boundary
+        pixels and adjacency) of the current label grid. It is computed on
+        first use and kept until the plates are grown again.
         """
-        rect = self.surface.to_rectangle()
-        # rect = self.surface.surface # For testing without transformation
-        h, w = rect.shape
+        if self._plate_index is None:
+            num_ids = max((plate.plate_id for plate in self.plates), default=0) + 1
+            self._plate_index = PlateIndex(self.surface.topology, self.surface.values(), num_ids)
+        return self._plate_index
 
-        # Assign colors for each plate (random but fixed for reproducibility)
-        np.random.seed(42)
-        plate_ids = [plate.plate_id for plate in self.plates]
-        colors = {
-            pid: tuple(np.random.randint(0, 256, 3)) for pid in plate_ids
-        }
-        colors[0] = (0, 0, 0)  # background
+    def lookup_table(self, values, background=0, dtype=None):
+        """
+        Builds an array indexed by plate id, so a whole label grid can be
+        mapped to per-plate attributes with one fancy-indexing pass.
+        values holds one entry (scalar or vector) per plate in self.plates;
+        id 0 and unused ids get background.
+        """
+        values = np.asarray(values, dtype=dtype)
+        plate_ids = np.array([plate.plate_id for plate in self.plates], dtype=np.int64)
+        table = np.empty((plate_ids.max(initial=0) + 1,) + values.shape[1:], dtype=values.dtype)
+        table[...] = background
+        table[plate_ids] = values
+        return table
 
-        # Create RGB image array
-        img_array = np.zeros((h, w, 3), dtype=np.uint8)
-        for pid, color in colors.items():
-            img_array[rect == pid] = color
+    def plate_colors(self):
+        """
+        Returns an (max plate id + 1, 3) uint8 colour table.
+        Each plate ID is assigned a distinguishable color, id 0 is black.
+        """
+        # Assign colors for each plate (random but fixed by the colouring seed)
+        colors = self.rng("colouring").integers(0, 256, (len(self.plates), 3))
+        return self.lookup_table(colors, background=0, dtype=np.uint8)
 
-        img = Image.fromarray(img_array, 'RGB')
+    def surface_to_image(self):
+        """
+        Converts the sphere surface to a rectangle and returns it as an image.
+        Each plate ID is assigned a distinguishable color.
+        """
+        pixels = self.surface.topology.height * self.equator_length
+        with self.instrumentation.stage("projection", pixels=pixels):
+            rect = self.surface.to_rectangle()
+        with self.instrumentation.stage("encoding", pixels=pixels):
+            img = Image.fromarray(self.plate_colors()[rect], 'RGB')
         return img
     
     def surface_to_image2(self):
@@ -125,21 +425,28 @@ class TectonicPlates:
         Each plate ID is assigned a distinguishable color.
         """
         rect = self.surface.to_rectangle2()
-        # rect = self.surface.surface # For testing without transformation
-        h, w = rect.shape
-
-        # Assign colors for each plate (random but fixed for reproducibility)
-        np.random.seed(42)
-        plate_ids = [plate.plate_id for plate in self.plates]
-        colors = {
-            pid: tuple(np.random.randint(0, 256, 3)) for pid in plate_ids
-        }
-        colors[0] = (0, 0, 0)  # background
+        img = Image.fromarray(self.plate_colors()[rect], 'RGB')
+        return img
 
-        # Create RGB image array
-        img_array = np.zeros((h, w, 3), dtype=np.uint8)
-        for pid, color in colors.items():
-            img_array[rect == pid] = color
+    def save_image(self, filename, band_rows=None):
+        """
+        Writes the plate colour image to a PNG file band by band, without
+        holding the full rectangle in memory (see SphereSurface.iter_rectangle).
+        """
+        colors = self.plate_colors()
+        bands = (colors[rect] for _, rect in self.surface.iter_rectangle(band_rows))
+        with self.instrumentation.stage("export", pixels=self.surface.topology.height * self.equator_length):
+            write_png(filename, self.equator_length, self.surface.topology.height, bands, "RGB")
 
-        img = Image.fromarray(img_array, 'RGB')
-        return img
+    def export_tiles(self, out_dir, tile_size=256, band_rows=None, workers=None):
+        """
+        Writes the plate colour image as a pyramid of RGB PNG tiles (see
+        TilePyramidWriter), streaming the projection band by band.
+        """
+        colors = self.plate_colors()
+        height = self.surface.topology.height
+        with self.instrumentation.stage("export", pixels=height * self.equator_length):
+            with TilePyramidWriter(out_dir, self.equator_length, height, "RGB",
+                                   tile_size=tile_size, workers=workers) as writer:
+                for _, rect in self.surface.iter_rectangle(band_rows):
+                    writer.write(colors[rect])
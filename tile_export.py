@@ -0,0 +1,140 @@
+import collections
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from png_writer import write_png
+
+class TilePyramidWriter:
+    """
+    Writes an image given as a stream of row bands as a pyramid of PNG tiles.
+
+    Zoom level z = levels - 1 is the full resolution; every lower level is
+    the previous one downsampled 2x2 (edge rows/columns of odd-sized levels
+    are repeated), down to z = 0 which fits in a single tile. Tiles are
+    out_dir/<z>/<x>_<y>.png, tile_size square except along the right and
+    bottom edges. Each level only buffers one strip of tile_size rows, and
+    tiles are encoded by a pool of worker threads (zlib releases the GIL).
+
+    mode is a png_writer mode: bands hold 0..255 values for "L"/"RGB" and
+    0..65535 for "I;16"; downsampled levels are averaged in float32 and
+    rounded when encoded.
+    """
+    def __init__(self, out_dir, width, height, mode="RGB", tile_size=256, workers=None, metadata=None):
+        self.out_dir = out_dir
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.tile_size = tile_size
+        self.metadata = metadata or {}
+        self.max_value = 65535 if mode == "I;16" else 255
+        self.out_dtype = np.uint16 if mode == "I;16" else np.uint8
+
+        # (width, height) of every level, full resolution first
+        self.sizes = [(width, height)]
+        while max(self.sizes[-1]) > tile_size:
+            w, h = self.sizes[-1]
+            self.sizes.append(((w + 1) // 2, (h + 1) // 2))
+        self.levels = len(self.sizes)
+
+        self._strips = [[] for _ in self.sizes]  # buffered rows per level
+        self._buffered = [0] * self.levels
+        self._tile_rows = [0] * self.levels  # next tile row index per level
+        self._carry = [None] * self.levels  # odd row waiting for its pair
+        workers = workers or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._max_pending = 4 * workers  # bounds the strips held by queued tiles
+        self._pending = collections.deque()
+        for z in range(self.levels):
+            os.makedirs(os.path.join(out_dir, str(z)), exist_ok=True)
+
+    def write(self, band):
+        """
+        Adds the next rows (n, width) or (n, width, 3) of the full image.
+        """
+        self._add(0, np.asarray(band, dtype=np.float32))
+
+    def close(self):
+        """
+        Flushes the partial strips, waits for the encoders and writes
+        tiles.json describing the pyramid.
+        """
+        try:
+            for level in range(self.levels):
+                if self._carry[level] is not None:
+                    # pair the odd last row with itself
+                    self._downsample(level, np.concatenate((self._carry[level], self._carry[level])))
+                    self._carry[level] = None
+                self._flush_strip(level)
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            self._pool.shutdown()
+        info = {
+            "width": self.width,
+            "height": self.height,
+            "tile_size": self.tile_size,
+            "levels": self.levels,
+            "mode": self.mode,
+            **self.metadata,
+        }
+        with open(os.path.join(self.out_dir, "tiles.json"), "w") as f:
+            json.dump(info, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.shutdown(cancel_futures=True)
+
+    def _add(self, level, rows):
+        if len(rows) == 0:
+            return
+        self._strips[level].append(rows)
+        self._buffered[level] += len(rows)
+        while self._buffered[level] >= self.tile_size:
+            strip = np.concatenate(self._strips[level])
+            self._strips[level] = [strip[self.tile_size:]]
+            self._buffered[level] -= self.tile_size
+            self._emit(level, strip[:self.tile_size])
+
+        if level + 1 < self.levels:
+            if self._carry[level] is not None:
+                rows = np.concatenate((self._carry[level], rows))
+                self._carry[level] = None
+            if len(rows) % 2:
+                self._carry[level] = rows[-1:]
+                rows = rows[:-1]
+            self._downsample(level, rows)
+
+    def _downsample(self, level, rows):
+        if len(rows) == 0:
+            return
+        pairs = rows[0::2] + rows[1::2]
+        if pairs.shape[1] % 2:
+            pairs = np.concatenate((pairs, pairs[:, -1:]), axis=1)
+        self._add(level + 1, (pairs[:, 0::2] + pairs[:, 1::2]) * 0.25)
+
+    def _flush_strip(self, level):
+        if self._buffered[level]:
+            self._emit(level, np.concatenate(self._strips[level]))
+        self._strips[level] = []
+        self._buffered[level] = 0
+
+    def _emit(self, level, strip):
+        # cut one strip into tiles and queue them for encoding
+        tiles = np.clip(np.rint(strip), 0, self.max_value).astype(self.out_dtype)
+        y = self._tile_rows[level]
+        self._tile_rows[level] += 1
+        z = self.levels - 1 - level
+        for x, x0 in enumerate(range(0, tiles.shape[1], self.tile_size)):
+            tile = tiles[:, x0:x0 + self.tile_size]
+            path = os.path.join(self.out_dir, str(z), f"{x}_{y}.png")
+            while len(self._pending) >= self._max_pending:
+                self._pending.popleft().result()
+            self._pending.append(self._pool.submit(write_png, path, tile.shape[1], tile.shape[0], (tile,), self.mode))
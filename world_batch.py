@@ -0,0 +1,196 @@
+import numpy as np
+
+from sphere_surface import sphere_topology
+from tectonic_plates import TectonicPlates, seed_plates, stage_seeds, seed_entropy
+from heigth_map import HeightMap
+from instrumentation import NO_INSTRUMENTATION
+
+class WorldBatch:
+    """
+    Generates many worlds of the same size and plate counts together.
+
+    labels (and heights, once set_heights() ran) are (B, size) arrays with
+    one world per seed, in compact order; labels_grid()/heights_grid()
+    give the (B, height, equator_length) surface arrays. All worlds share
+    one SphereTopology, and growth and smoothing run on the whole batch at
+    once, so the per-world Python overhead is paid once per batch. Every
+    world is identical to TectonicPlates(seed=seed).draw_plates() and
+    HeightMap(plates, ...) for its seed; world() returns those objects.
+    """
+    def __init__(self, equator_length, seeds, num_continental, num_oceanic, growth_rate_range=3, dtype=None,
+                 instrumentation=None):
+        if dtype is None:
+            dtype = np.min_scalar_type(num_continental + num_oceanic)
+        if num_continental + num_oceanic > np.iinfo(dtype).max:
+            raise ValueError(f"{num_continental + num_oceanic} plates do not fit in {np.dtype(dtype).name} labels")
+        self.equator_length = equator_length
+        self.topology = sphere_topology(equator_length)
+        self.instrumentation = instrumentation or NO_INSTRUMENTATION
+        self.seed_sequences = []
+        self.plates = []
+        with self.instrumentation.stage("seeding", pixels=len(seeds) * (num_continental + num_oceanic)):
+            for seed in seeds:
+                sequence, seeds_by_stage = stage_seeds(seed)
+                self.seed_sequences.append(sequence)
+                self.plates.append(seed_plates(self.topology, seeds_by_stage, num_continental, num_oceanic,
+                                               growth_rate_range))
+        self.labels = np.zeros((len(seeds), self.topology.size), dtype=dtype)
+        self.heights = None
+        self.height_params = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def draw_plates(self):
+        """
+        Grows the plates of every world. Plates take turns in id order like
+        in TectonicPlates.draw_plates; each turn grows that plate in all
+        worlds with one neighbour gather over the concatenated frontiers.
+        """
+        topology = self.topology
+        size = topology.size
+        # flat view: pixel p of world b is b * size + p
+        labels = self.labels.reshape(-1)
+        labels[:] = 0
+        world_starts = np.arange(len(self), dtype=np.int64) * size
+        degree = np.diff(topology.neighbours()[0])
+        # scratch for dropping duplicate candidates without sorting:
+        # a candidate is kept where it was the last one written to its pixel
+        last_writer = np.empty(labels.size, dtype=np.int64)
+
+        num_plates = len(self.plates[0]) if len(self) else 0
+        rates = np.array([[plate.growth_rate for plate in plates] for plates in self.plates], dtype=np.int64)
+        frontiers = []
+        for i in range(num_plates):
+            seeds = world_starts + np.array([topology.compact(plates[i].longitude, plates[i].latitude)
+                                             for plates in self.plates], dtype=np.int64)
+            seeds = seeds[labels[seeds] == 0]
+            labels[seeds] = i + 1
+            frontiers.append(seeds)
+
+        instrumentation = self.instrumentation
+        step = 0
+        total_pixels = labels.size
+        free_pixels = total_pixels - int(np.count_nonzero(labels))
+        with instrumentation.stage("growth", pixels=free_pixels):
+            previous_round_free = free_pixels
+            while free_pixels > 0:
+                step += 1
+                for i in range(num_plates):
+                    frontier = frontiers[i]
+                    for g in range(int(rates[:, i].max(initial=0))):
+                        # worlds whose plate i grows less than g + 1 times keep their frontier
+                        growing = rates[frontier // size, i] > g
+                        resting = frontier[~growing]
+                        frontier = frontier[growing]
+                        if len(frontier) == 0:
+                            frontier = resting
+                            break
+                        local = frontier % size
+                        _, candidates = topology.neighbours_of(local)
+                        candidates = candidates + np.repeat(frontier - local, degree[local])
+                        candidates = candidates[labels[candidates] == 0]
+                        order = np.arange(len(candidates))
+                        last_writer[candidates] = order
+                        claimed = candidates[last_writer[candidates] == order]
+                        labels[claimed] = i + 1
+                        free_pixels -= len(claimed)
+                        frontier = np.concatenate((resting, claimed))
+                    frontiers[i] = frontier
+                if instrumentation.enabled:
+                    instrumentation.event(
+                        "growth_step",
+                        step=step,
+                        free_pixels=free_pixels,
+                        total_pixels=total_pixels,
+                        frontier_pixels=sum(len(frontier) for frontier in frontiers),
+                        claimed_pixels=previous_round_free - free_pixels,
+                    )
+                if free_pixels == previous_round_free:
+                    # no more growth possible in any world
+                    break
+                previous_round_free = free_pixels
+
+    def set_heights(self, base_ocean=20, base_continent=60, smooth_window=3, dtype=np.float32, band_rows=None):
+        """
+        Computes the heights of every world like HeightMap (without boundary
+        terrain): base heights from the plate types, then the box filter,
+        run on bands of rows of all worlds at once.
+        """
+        topology = self.topology
+        smooth_window = max(1, int(smooth_window))
+        if smooth_window % 2 == 0:
+            smooth_window += 1
+        self.height_params = {"base_ocean": int(base_ocean), "base_continent": int(base_continent),
+                              "smooth_window": smooth_window}
+        pixels = self.labels.size
+
+        with self.instrumentation.stage("base_heights", pixels=pixels):
+            num_ids = max(len(plates) for plates in self.plates) + 1 if len(self) else 1
+            table = np.full((len(self), num_ids), int(base_ocean), dtype=dtype)
+            for b, plates in enumerate(self.plates):
+                for plate in plates:
+                    table[b, plate.plate_id] = base_continent if plate.plate_type == 'continental' else base_ocean
+            heights = np.take_along_axis(table, self.labels.astype(np.intp), axis=1)
+
+        if smooth_window > 1:
+            with self.instrumentation.stage("smoothing", pixels=pixels):
+                half_size = smooth_window // 2
+                if band_rows is None:
+                    band_rows = (1 << 20) // max(1, self.equator_length * len(self))
+                band_rows = max(1, int(band_rows))
+                smoothed = np.empty_like(heights)
+                for y0 in range(0, topology.height, band_rows):
+                    y1 = min(y0 + band_rows, topology.height)
+                    r0 = max(0, y0 - half_size)
+                    r1 = min(topology.height, y1 + half_size)
+                    values = heights[:, topology.row_starts[r0]:topology.row_starts[r1]]
+                    smoothed[:, topology.row_starts[y0]:topology.row_starts[y1]] = \
+                        topology.box_filter_band(values, y0, y1, smooth_window, heights.dtype)
+                heights = smoothed
+        self.heights = heights
+
+    def _grid(self, values):
+        grid = np.zeros((len(self), self.topology.height * self.equator_length), dtype=values.dtype)
+        grid[:, self.topology.flat_index] = values
+        return grid.reshape(len(self), self.topology.height, self.equator_length)
+
+    def labels_grid(self):
+        """
+        Returns the labels as a (B, height, equator_length) array, with 0
+        outside the valid band of each row.
+        """
+        return self._grid(self.labels)
+
+    def heights_grid(self):
+        """
+        Returns the heights as a (B, height, equator_length) array.
+        """
+        return self._grid(self.heights)
+
+    def world(self, b, storage="padded"):
+        """
+        Returns (plates, heightmap) for world b as regular TectonicPlates and
+        HeightMap objects (heightmap is None before set_heights()).
+        """
+        plates = self.plates[b]
+        sequence = self.seed_sequences[b]
+        tectonic_plates = TectonicPlates.from_arrays({
+            "equator_length": np.array(self.equator_length),
+            "labels": self.labels[b],
+            "plate_ids": np.array([p.plate_id for p in plates], dtype=np.int64),
+            "continental": np.array([p.plate_type == 'continental' for p in plates], dtype=bool),
+            "growth_rates": np.array([p.growth_rate for p in plates], dtype=np.int64),
+            "seed_longitudes": np.array([p.longitude for p in plates], dtype=np.int64),
+            "seed_latitudes": np.array([p.latitude for p in plates], dtype=np.int64),
+            "seed_entropy": np.array(seed_entropy(sequence)),
+            "seed_spawn_key": np.array(sequence.spawn_key, dtype=np.int64),
+        }, storage=storage, instrumentation=self.instrumentation)
+        if self.heights is None:
+            return tectonic_plates, None
+        hmap = HeightMap.from_arrays(tectonic_plates, {
+            "heights": self.heights[b],
+            "boundary_terrain": np.array(False),
+            **{name: np.array(value) for name, value in self.height_params.items()},
+        })
+        return tectonic_plates, hmap
@@ -0,0 +1,293 @@
+import collections
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from sphere_surface import sphere_topology
+from tectonic_plates import TectonicPlates, Plate, seed_entropy
+from heigth_map import HeightMap
+
+# File layout (all little endian):
+#   header: magic, format version, index offset, index length
+#   sections: the plate table and the surface buffers, each 64-byte aligned
+#   index: UTF-8 JSON describing the world and where each section is
+# The index is written last so surfaces can be streamed band by band.
+WORLD_MAGIC = b"MAPGENW\0"
+WORLD_FORMAT_VERSION = 1
+_HEADER = struct.Struct("<8sIQQ")
+_ALIGNMENT = 64
+
+WORLD_COMPRESSIONS = (None, "zlib")
+
+# One record per plate; angular velocities are recomputed from the seed
+PLATE_DTYPE = np.dtype([
+    ("plate_id", "<i4"),
+    ("continental", "u1"),
+    ("growth_rate", "<i4"),
+    ("seed_longitude", "<i4"),
+    ("seed_latitude", "<i4"),
+])
+
+# Decompressed chunks kept per open WorldFile
+CHUNK_CACHE_SIZE = 16
+
+def _pad(f):
+    f.write(b"\0" * (-f.tell() % _ALIGNMENT))
+
+def _write_buffer(f, surface, compression, chunk_rows, level):
+    """
+    Writes the valid pixels of surface in compact order, band by band, and
+    returns the index entry of the buffer.
+    """
+    dtype = surface.dtype.newbyteorder("<")
+    _pad(f)
+    entry = {"dtype": dtype.str, "compression": compression or "none", "offset": f.tell()}
+    if compression is None:
+        for r0, r1 in surface.iter_bands():
+            f.write(np.ascontiguousarray(surface.rows_values(r0, r1), dtype=dtype).tobytes())
+        entry["nbytes"] = f.tell() - entry["offset"]
+        return entry
+
+    entry["chunk_rows"] = chunk_rows
+    chunks = []
+    for r0, r1 in surface.iter_bands(chunk_rows):
+        data = zlib.compress(np.ascontiguousarray(surface.rows_values(r0, r1), dtype=dtype).tobytes(), level)
+        chunks.append([f.tell(), len(data)])
+        f.write(data)
+    entry["chunks"] = chunks
+    return entry
+
+def save_world(filename, plates, hmap=None, compression=None, chunk_rows=None, level=6):
+    """
+    Writes a grown TectonicPlates (and optionally its HeightMap) to a world
+    file: the plate table, the seed and the label and height surfaces.
+
+    Surfaces are stored as their valid pixels in compact order, raw or,
+    with compression="zlib", as independently compressed chunks of
+    chunk_rows latitude rows (default: about 64K pixels per chunk), so
+    random reads only inflate the chunks they touch. Read it back with
+    WorldFile.
+    """
+    if compression not in WORLD_COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    topology = plates.surface.topology
+    if chunk_rows is None:
+        chunk_rows = (1 << 16) // plates.equator_length
+    chunk_rows = max(1, int(chunk_rows))
+
+    plate_table = np.zeros(len(plates.plates), dtype=PLATE_DTYPE)
+    plate_table["plate_id"] = [p.plate_id for p in plates.plates]
+    plate_table["continental"] = [p.plate_type == 'continental' for p in plates.plates]
+    plate_table["growth_rate"] = [p.growth_rate for p in plates.plates]
+    plate_table["seed_longitude"] = [p.longitude for p in plates.plates]
+    plate_table["seed_latitude"] = [p.latitude for p in plates.plates]
+
+    index = {
+        "equator_length": int(plates.equator_length),
+        "size": int(topology.size),
+        "seed_entropy": seed_entropy(plates.seed_sequence),
+        "seed_spawn_key": [int(k) for k in plates.seed_sequence.spawn_key],
+        "plates": {"count": len(plate_table)},
+        "heights": None,
+        "buffers": {},
+    }
+    pixels = topology.size * (1 if hmap is None else 2)
+    with plates.instrumentation.stage("export", pixels=pixels), open(filename, "wb") as f:
+        f.write(_HEADER.pack(WORLD_MAGIC, WORLD_FORMAT_VERSION, 0, 0))
+        _pad(f)
+        index["plates"]["offset"] = f.tell()
+        f.write(plate_table.tobytes())
+
+        index["buffers"]["labels"] = _write_buffer(f, plates.surface, compression, chunk_rows, level)
+        if hmap is not None:
+            index["buffers"]["heights"] = _write_buffer(f, hmap.height_surface, compression, chunk_rows, level)
+            index["heights"] = {
+                "base_ocean": hmap.base_ocean,
+                "base_continent": hmap.base_continent,
+                "smooth_window": hmap.smooth_window,
+                "boundary_terrain": hmap.boundary_terrain,
+            }
+
+        index_data = json.dumps(index).encode()
+        index_offset = f.tell()
+        f.write(index_data)
+        f.seek(0)
+        f.write(_HEADER.pack(WORLD_MAGIC, WORLD_FORMAT_VERSION, index_offset, len(index_data)))
+
+class WorldFile:
+    """
+    Read-only access to a world file written by save_world().
+
+    Opening only parses the header and the index; the file is memory-mapped,
+    so raw buffers are read straight from the page cache and compressed
+    ones one chunk at a time. get()/get_many(), read_rows() and
+    read_pixels() read single pixels, latitude bands or arbitrary pixels of
+    the "labels" or "heights" buffer; to_plates() and to_heightmap() load everything.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._map = np.memmap(filename, dtype=np.uint8, mode="r")
+        if len(self._map) < _HEADER.size:
+            raise ValueError(f"{filename} is not a world file")
+        magic, version, index_offset, index_length = _HEADER.unpack(bytes(self._map[:_HEADER.size]))
+        if magic != WORLD_MAGIC:
+            raise ValueError(f"{filename} is not a world file")
+        if version > WORLD_FORMAT_VERSION:
+            raise ValueError(f"{filename} has world format version {version}, "
+                             f"this reader supports up to {WORLD_FORMAT_VERSION}")
+        if index_offset == 0:
+            raise ValueError(f"{filename} is incomplete")
+        self.version = version
+        self.index = json.loads(bytes(self._map[index_offset:index_offset + index_length]))
+        self.equator_length = self.index["equator_length"]
+        self.topology = sphere_topology(self.equator_length)
+
+        plates = self.index["plates"]
+        self.plate_table = self._map[plates["offset"]:plates["offset"] + plates["count"] * PLATE_DTYPE.itemsize]
+        self.plate_table = self.plate_table.view(PLATE_DTYPE)
+        self.height_params = self.index["heights"]
+        self._chunks = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Releases the memory map (arrays returned for raw buffers keep it alive).
+        """
+        self._map = None
+        self._chunks.clear()
+
+    @property
+    def buffers(self):
+        """Names of the stored surfaces."""
+        return tuple(self.index["buffers"])
+
+    @property
+    def plates(self):
+        """The plate table as Plate objects."""
+        return [
+            Plate(int(p["plate_id"]), int(p["seed_latitude"]), int(p["seed_longitude"]),
+                  'continental' if p["continental"] else 'oceanic', int(p["growth_rate"]))
+            for p in self.plate_table
+        ]
+
+    def _entry(self, name):
+        try:
+            return self.index["buffers"][name]
+        except KeyError:
+            raise KeyError(f"{self.filename} has no {name!r} buffer") from None
+
+    def _raw(self, entry):
+        return self._map[entry["offset"]:entry["offset"] + entry["nbytes"]].view(entry["dtype"])
+
+    def _chunk(self, name, chunk):
+        key = (name, chunk)
+        if key in self._chunks:
+            self._chunks.move_to_end(key)
+            return self._chunks[key]
+        entry = self._entry(name)
+        offset, nbytes = entry["chunks"][chunk]
+        values = np.frombuffer(zlib.decompress(self._map[offset:offset + nbytes]), dtype=entry["dtype"])
+        self._chunks[key] = values
+        if len(self._chunks) > CHUNK_CACHE_SIZE:
+            self._chunks.popitem(last=False)
+        return values
+
+    def read_rows(self, name, r0, r1):
+        """
+        Returns the valid pixels of rows r0..r1 of a buffer in compact order
+        (a read-only view of the file for raw buffers).
+        """
+        entry = self._entry(name)
+        row_starts = self.topology.row_starts
+        if entry["compression"] == "none":
+            return self._raw(entry)[row_starts[r0]:row_starts[r1]]
+        chunk_rows = entry["chunk_rows"]
+        parts = []
+        for chunk in range(r0 // chunk_rows, (max(r1, r0 + 1) - 1) // chunk_rows + 1):
+            c0 = chunk * chunk_rows
+            c1 = min(c0 + chunk_rows, self.topology.height)
+            lo = row_starts[max(r0, c0)] - row_starts[c0]
+            hi = row_starts[min(r1, c1)] - row_starts[c0]
+            parts.append(self._chunk(name, chunk)[lo:hi])
+        return np.concatenate(parts) if parts else np.empty(0, dtype=entry["dtype"])
+
+    def read(self, name):
+        """
+        Returns a whole buffer in compact order.
+        """
+        return self.read_rows(name, 0, self.topology.height)
+
+    def read_pixels(self, name, pixels):
+        """
+        Returns the values of a buffer at an array of compact pixel indices,
+        inflating only the chunks that hold them.
+        """
+        entry = self._entry(name)
+        pixels = np.asarray(pixels, dtype=np.int64)
+        if entry["compression"] == "none":
+            return self._raw(entry)[pixels]
+        rows = np.searchsorted(self.topology.row_starts, pixels, side="right") - 1
+        chunks = rows // entry["chunk_rows"]
+        values = np.empty(pixels.shape, dtype=entry["dtype"])
+        for chunk in np.unique(chunks):
+            selected = chunks == chunk
+            first = self.topology.row_starts[chunk * entry["chunk_rows"]]
+            values[selected] = self._chunk(name, int(chunk))[pixels[selected] - first]
+        return values
+
+    def get(self, lon, lat, name="heights"):
+        """
+        Returns the value at (lon, lat) like SphereSurface.get: lon is the
+        row and wraps over the rows, lat wraps around the row.
+        """
+        longitude = lon % self.topology.height
+        return self.read_pixels(name, self.topology.compact(longitude, lat))[()]
+
+    def get_many(self, lon, lat, name="heights"):
+        """
+        Vectorized get(): returns the values at arrays of coordinates.
+        """
+        longitude = np.asarray(lon) % self.topology.height
+        return self.read_pixels(name, self.topology.compact(longitude, np.asarray(lat)))
+
+    def to_plates(self, storage="padded", instrumentation=None):
+        """
+        Loads the labels and plate table as a TectonicPlates.
+        """
+        table = self.plate_table
+        return TectonicPlates.from_arrays({
+            "equator_length": np.array(self.equator_length),
+            "labels": self.read("labels"),
+            "plate_ids": table["plate_id"].astype(np.int64),
+            "continental": table["continental"].astype(bool),
+            "growth_rates": table["growth_rate"].astype(np.int64),
+            "seed_longitudes": table["seed_longitude"].astype(np.int64),
+            "seed_latitudes": table["seed_latitude"].astype(np.int64),
+            "seed_entropy": np.array(self.index["seed_entropy"]),
+            "seed_spawn_key": np.array(self.index["seed_spawn_key"], dtype=np.int64),
+        }, storage=storage, instrumentation=instrumentation)
+
+    def to_heightmap(self, plates):
+        """
+        Loads the heights as a HeightMap of plates (from to_plates()), or
+        returns None if the file has no heights.
+        """
+        if self.height_params is None:
+            return None
+        return HeightMap.from_arrays(plates, {
+            "heights": self.read("heights"),
+            **{name: np.array(value) for name, value in self.height_params.items()},
+        })
+
+def open_world(filename):
+    """
+    Opens a world file for reading; see WorldFile.
+    """
+    return WorldFile(filename)